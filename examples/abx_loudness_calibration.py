@@ -2,8 +2,9 @@ import os
 import logging
 import soundfile as sf
 import argparse, sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from argparse import RawTextHelpFormatter
-from _abx_test_straight_preparation import loudness_lvl_normalize, write_audio
+from _abx_test_straight_preparation import loudness_lvl_normalize, AUDIO_EXTENSIONS
 
 desc_str = """
 Program for loudness normalization used primarily for ABX listening tests.
@@ -49,48 +50,45 @@ calibrated
 └── ...
 """
 
-parser = argparse.ArgumentParser(description=desc_str, formatter_class=RawTextHelpFormatter)
-
-
-parser.add_argument(
-    "-dbfs", 
-    "--dBFS-to-dB",
-    type=float,
-    help="dBFS to dB SPL headphones calibration."
-    )
-parser.add_argument(
-    "-phon", 
-    "--loudness-lvl",
-    type=float,
-    help="Target loudness level after calibration."
-    )
-parser.add_argument(
-    "-loc", 
-    "--location",
-    type=str,
-    help="Path to the folder with pre-baked sounds."
-    )
-
-
-args =  parser.parse_args()
-
-print(args)
-
-stim = os.listdir(args.location)  # list of subfolders
-dbfs_db = args.dBFS_to_dB  # dBFS to dB SPL headphones calibration
-target_phon = args.loudness_lvl  # target loudness level after calibration
-source_dir = args.location  # path to the folder with pre-baked sounds
-destination_dir = os.path.join(os.path.dirname(source_dir), "calibrated")  # path to the folder where the normalized sounds will be saved
-
-for s in stim:
+def process_subfolder(
+        s: str,
+        source_dir: str,
+        destination_dir: str,
+        target_phon: float,
+        dbfs_db: float
+        ) -> str:
+    """Calibrate all the files of a single subfolder.
+
+    Parameters
+    ----------
+    s : str
+        Name of the subfolder.
+    source_dir : str
+        Path to the folder with pre-baked sounds.
+    destination_dir : str
+        Path to the folder where the normalized sounds will be saved.
+    target_phon : float
+        Target loudness level after calibration.
+    dbfs_db : float
+        dBFS to dB SPL headphones calibration.
+
+    Returns
+    -------
+    str
+        Name of the processed subfolder.
+    """
     # read whole folder with pre-baked sounds
     source = os.path.join(source_dir, s)
     destination = os.path.join(destination_dir, s)
-    file_paths = os.listdir(source)
+    entries = sorted(
+        (e for e in os.scandir(source)
+         if e.is_file() and e.name.lower().endswith(AUDIO_EXTENSIONS)),
+        key=lambda e: e.name
+        )
 
     # read single file used for normalization
-    logging.info(f"==={file_paths[0]}===")
-    stimulus, fs_stimulus = sf.read(os.path.join(source,file_paths[0]), always_2d=True)
+    logging.info(f"==={entries[0].name}===")
+    stimulus, fs_stimulus = sf.read(entries[0].path, always_2d=True, dtype='float32')
 
     # loudness normalize
     ratio = loudness_lvl_normalize(
@@ -100,9 +98,57 @@ for s in stim:
         dbfs_db, 
         return_ratio=True
         )
-    for f in file_paths:
-        audio, fs = sf.read(os.path.join(source,f), always_2d=True)
-        audio *= ratio
-        write_audio(audio, fs, destination, f)
+    os.makedirs(destination, exist_ok=True)
+    for e in entries:
+        # stream in blocks so that memory does not grow with file length
+        with sf.SoundFile(e.path) as rf, sf.SoundFile(
+                os.path.join(destination, e.name), 'w', rf.samplerate, rf.channels,
+                subtype=rf.subtype) as wf:
+            for block in rf.blocks(blocksize=65536, always_2d=True, dtype='float32'):
+                block *= ratio
+                wf.write(block)
+    return s
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=desc_str, formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument(
+        "-dbfs", 
+        "--dBFS-to-dB",
+        type=float,
+        help="dBFS to dB SPL headphones calibration."
+        )
+    parser.add_argument(
+        "-phon", 
+        "--loudness-lvl",
+        type=float,
+        help="Target loudness level after calibration."
+        )
+    parser.add_argument(
+        "-loc", 
+        "--location",
+        type=str,
+        help="Path to the folder with pre-baked sounds."
+        )
+
+    args =  parser.parse_args()
+
+    print(args)
+
+    stim = sorted(e.name for e in os.scandir(args.location) if e.is_dir())  # list of subfolders
+    dbfs_db = args.dBFS_to_dB  # dBFS to dB SPL headphones calibration
+    target_phon = args.loudness_lvl  # target loudness level after calibration
+    source_dir = args.location  # path to the folder with pre-baked sounds
+    destination_dir = os.path.join(os.path.dirname(source_dir), "calibrated")  # path to the folder where the normalized sounds will be saved
+
+    # subfolders are independent, the loudness model is CPU bound
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [
+            executor.submit(process_subfolder, s, source_dir, destination_dir, target_phon, dbfs_db)
+            for s in stim
+            ]
+        for future in as_completed(futures):
+            logging.info(f"Subfolder {future.result()} calibrated.")
 
-logging.info("Succesfully exported normalized files.")
\ No newline at end of file
+    logging.info("Succesfully exported normalized files.")
@@ -3,18 +3,20 @@
 import soundfile as sf
 import os
 import logging
-from scipy.signal import resample
-import mosqito
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
 from typing import List, Tuple, Union
 import numpy as np
 
-from listeningpy.processing import convolution
-from listeningpy.normalization import peak_normalize
+from listeningpy.processing import prepare_ir, StimulusConvolutionEngine
+from listeningpy.normalization import peak_normalize, zwicker_loudness_normalize
 logging.basicConfig(format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
                     datefmt='%H:%M:%S',
                     level=logging.INFO)
 
+AUDIO_EXTENSIONS = ('.wav', '.flac')
+
 def read_ir_list(
         ir_folder_path: str
         ) -> Tuple[List[np.ndarray], List[int], List[str]]: 
@@ -34,22 +36,24 @@ def read_ir_list(
         - fs_irs (List[int]): A list of sample rates corresponding to each IR.
         - variants (List[str]): A list of variant names for each IR file.
     """    
-    irs = []
-    fs_irs = []
-    ir_files = os.listdir(ir_folder_path)
-    ir_paths = []
-    variants = []
-    for i in ir_files:
-        ir_paths.append(os.path.join(ir_folder_path, i))
-        char_idx_low = i.rfind("_")+1
-        variants.append(i[char_idx_low:-4])
+    entries = sorted(
+        (e for e in os.scandir(ir_folder_path)
+         if e.is_file() and e.name.lower().endswith(AUDIO_EXTENSIONS)),
+        key=lambda e: e.name
+        )
+    ir_paths = [e.path for e in entries]
+    variants = [os.path.splitext(e.name)[0].rsplit("_", 1)[-1] for e in entries]
 
     logging.debug(variants)
 
-    for i in ir_paths:
-        ir, fs_ir = sf.read(i, always_2d=True)
-        irs.append(ir)
-        fs_irs.append(fs_ir)
+    # soundfile releases the GIL while reading, so the reads overlap
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(
+            lambda p: sf.read(p, always_2d=True, dtype='float32'),
+            ir_paths
+            ))
+    irs = [ir for ir, _ in results]
+    fs_irs = [fs_ir for _, fs_ir in results]
     return irs, fs_irs, variants
 
 def batch_convolution(
@@ -61,11 +65,17 @@ def batch_convolution(
         stim_str: str, 
         peak_lvl: int = -12, 
         prefix: str = "13ab00ad", 
-        destination: str = "."
+        destination: str = ".",
+        max_workers: int = None
         ) -> None:
     """
     Perform batch convolution of impulse responses with stimuli and save the resulting audio files.
 
+    The stimuli are split into blocks and transformed once, each variant
+    only transforms its IR. The first variant is convolved in the calling
+    process to derive the common peak normalization factor, the remaining
+    ones are convolved in parallel worker processes.
+
     Parameters
     ----------
     irs : List[np.ndarray]
@@ -86,95 +96,97 @@ def batch_convolution(
         Prefix for the output file names. Default is "13ab00ad".
     destination : str, optional
         Destination directory to save the output files. Default is current directory.
+    max_workers : int, optional
+        Number of worker processes, by default the number of CPUs.
     """
     if not os.path.exists(destination):
         os.makedirs(destination)
-    test_audio, fs = convolution(irs[0], fs_irs[0], stimuli, fs_stimuli,
-            normalization=None
-            )
-    _test_audio, fs = peak_normalize(test_audio, fs, peak_lvl)
-
-    factor = _test_audio.max()/test_audio.max()
-
-    for ir, fs_ir, v in zip(irs, fs_irs, variants):
-        test_audio, fs = convolution(ir, fs_ir, stimuli, fs_stimuli,
-            normalization=None
-            )
-        test_audio *= factor
-        sf.write(os.path.join(destination, f'{prefix}_{v}_{stim_str}.wav'), test_audio, fs)
-
-
-def fs_to_pressure(
-        audio: np.ndarray, 
-        dbfs_db: float, 
-        p0: float = 2e-5
-        ) -> np.ndarray:
+    # the first and last channels, as in listeningpy.processing.convolution
+    irs = [prepare_ir(ir, fs_ir, fs_stimuli)[0][:, [0, -1]]
+           for ir, fs_ir in zip(irs, fs_irs)]
+    stimuli = np.asarray(stimuli, dtype=np.float32)[:, [0, -1]]
+    engine = StimulusConvolutionEngine(stimuli, max(ir.shape[0] for ir in irs))
+
+    test_audio = engine.convolve(irs[0])
+    _test_audio, fs = peak_normalize(test_audio, fs_stimuli, peak_lvl)
+
+    factor = np.float32(_test_audio.max()/test_audio.max())
+
+    # the first variant is already convolved, only scale and write it
+    test_audio *= factor
+    sf.write(os.path.join(destination, f'{prefix}_{variants[0]}_{stim_str}.wav'), test_audio, fs)
+
+    if len(irs) == 1:
+        return
+    # share the stimulus spectra with the workers instead of pickling them per task
+    spectra = engine.spectra
+    shm = SharedMemory(create=True, size=spectra.nbytes)
+    try:
+        np.ndarray(spectra.shape, spectra.dtype, buffer=shm.buf)[:] = spectra
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    _convolve_variant, 
+                    shm.name, spectra.shape, spectra.dtype, 
+                    stimuli.shape[0], engine.max_ir_len, engine.block_size,
+                    ir, fs, factor,
+                    os.path.join(destination, f'{prefix}_{v}_{stim_str}.wav')
+                    )
+                for ir, v in zip(irs[1:], variants[1:])
+                ]
+            for future in futures:
+                future.result()
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _convolve_variant(
+        shm_name: str, 
+        shape: Tuple[int, ...], 
+        dtype: np.dtype, 
+        length: int,
+        max_ir_len: int,
+        block_size: int,
+        ir: np.ndarray, 
+        fs: int, 
+        factor: float, 
+        path: str
+        ) -> None:
     """
-    Convert audio signal from dBFS to pressure level.
-
-    Parameters
-    ----------
-    audio : ndarray
-        The audio signal in dBFS (decibels relative to full scale).
-    dbfs_db : float
-        The reference level in dBFS.
-    p0 : float, optional
-        The reference pressure level in pascals, by default 2e-5.
-
-    Returns
-    -------
-    ndarray
-        The audio signal converted to pressure level.
+    Convolve the shared-memory stimulus spectra with a single IR, scale and write it.
 
+    Worker of `batch_convolution`, `shm_name`, `shape` and `dtype`
+    describe the stimulus block spectra placed in shared memory by the
+    caller, `length`, `max_ir_len` and `block_size` the engine that
+    computed them. The IR is already prepared by `prepare_ir`.
     """
-    ratio_db = p0 * 10 ** (dbfs_db/20)
-    audio_pressure = audio * ratio_db
-    return audio_pressure
+    shm = SharedMemory(name=shm_name)
+    try:
+        spectra = np.ndarray(shape, dtype, buffer=shm.buf)
+        # the pool already uses all the cores, one FFT thread per worker
+        engine = StimulusConvolutionEngine.from_spectra(
+            spectra, length, max_ir_len, block_size, workers=1)
+        test_audio = engine.convolve(ir)
+        del spectra, engine
+        test_audio *= factor
+        sf.write(path, test_audio, fs)
+    finally:
+        shm.close()
 
-def eq_loudness_lvl(
-        audio_pressure: np.ndarray, 
-        fs: int, 
-        field_type: str = "diffuse"
-        ) -> Tuple[float, Tuple[np.ndarray, np.ndarray]]:
-    """Calculate the log mean loudness level of an audio signal.
-
-    Parameters
-    ----------
-    audio_pressure : ndarray
-        Array containing the audio pressure values.
-    fs : int
-        Sampling frequency of the audio signal.
-    field_type : str, optional
-        Type of sound field. Possible values are "diffuse" (default) or "free".
-    
-    Returns
-    -------
-    float
-        The equal loudness level in dB.
-    tuple
-        A tuple containing the loudness values and corresponding time values.
-    """
-    audio_pressure = audio_pressure.mean(axis=1)
-    audio_pressure = resample(audio_pressure, int(audio_pressure.shape[0]*48000/fs))
-    fs=48000
-    N, N_spec, _, time = mosqito.loudness_zwtv(
-        audio_pressure.T, 
-        fs, 
-        field_type=field_type
-    )
-    loud_lvl = 40 + 10*np.log2(N.mean())
-    return loud_lvl, (N, time)
 
 def loudness_lvl_normalize(
         audio: np.ndarray, 
         fs: int, 
         target_phon: float, 
         dbfs_db: float, 
-        return_ratio: bool = False
+        return_ratio: bool = False,
+        max_iter: int = 3
         ) -> Union[float, Tuple[np.ndarray, int]]:
     """
     Normalize the loudness level of an audio signal.
 
+    Wraps `listeningpy.normalization.zwicker_loudness_normalize`.
+
     Parameters
     ----------
     audio : ndarray
@@ -187,6 +199,9 @@ def loudness_lvl_normalize(
         The reference level in dBFS.
     return_ratio : bool, optional
         If True, the normalization factor is returned, by default False.
+    max_iter : int, optional
+        Maximum number of gain updates (loudness evaluations after the
+        initial one), by default 3.
 
     Returns
     -------
@@ -196,31 +211,9 @@ def loudness_lvl_normalize(
         The normalized audio signal.
     int
         The sampling frequency of the normalized audio signal.
-
     """
-    audio_pressure = fs_to_pressure(audio, dbfs_db)
-    loud_lvl, loudness = eq_loudness_lvl(audio_pressure, fs)
-    loud_diff = target_phon - loud_lvl
-    ratio = 1
-    while abs(loud_diff) > 0.1:
-        ratio *= 10 ** ((loud_diff)/20)
-        audio_pressure_it = audio_pressure * ratio
-        loud_lvl, loudness = eq_loudness_lvl(audio_pressure_it, fs)
-        loud_diff = target_phon - loud_lvl
-        logging.debug(loud_diff)
-    audio *= ratio
-    headroom = 1/abs(audio).max()
-    headroom_db = 20*np.log10(headroom)
-    if abs(audio).max() > 1:
-        logging.warning("Audio signal clipped after normalization.")
-        raise ValueError("Audio signal clipped after normalization. "+
-                         f"The level overflows for {headroom_db:.2f} dB. "+
-                         "Adjust headphone level.")
-    else:
-        logging.info(f"Audio signal normalized to {target_phon:.2f} phons.")
-        logging.info(f"Normalization factor: {ratio:.2f}")
-        logging.info(f"Headroom: {headroom_db:.2f} dB")
-    
+    audio, fs, ratio = zwicker_loudness_normalize(
+        audio, fs, target_phon, dbfs_db, return_ratio=True, max_iter=max_iter)
     if return_ratio:
         return ratio
     else:
@@ -230,7 +223,8 @@ def write_audio(
         audio: np.ndarray, 
         fs: int, 
         destination: str, 
-        filename: str
+        filename: str,
+        subtype: str = None
         ) -> None:
     """
     Write audio data to a file.
@@ -245,11 +239,17 @@ def write_audio(
         The destination directory where the file will be saved.
     filename : str
         The name of the file.
+    subtype : str, optional
+        The soundfile subtype, e.g. 'PCM_24'. The format default is used
+        if not provided.
 
     Returns
     -------
     None
     """
-    if not os.path.exists(destination):
-        os.makedirs(destination)
-    sf.write(os.path.join(destination, filename), audio, fs)
\ No newline at end of file
+    os.makedirs(destination, exist_ok=True)
+    channels = audio.shape[1] if audio.ndim == 2 else 1
+    with sf.SoundFile(
+            os.path.join(destination, filename), 'w', fs, channels,
+            subtype=subtype) as wf:
+        wf.write(audio)
\ No newline at end of file
@@ -9,8 +9,7 @@ with a specified correction in decibels.
 """
 from customtkinter import CTk, CTkFrame, CTkButton, CTkLabel, CTkEntry, StringVar, CENTER
 import numpy as np
-from numpy import ndarray, empty, mean, concatenate, sqrt, zeros
-from numpy.random import uniform
+from numpy import ndarray, sqrt, zeros
 import sounddevice as sd
 import soundfile as sf
 import os
@@ -45,23 +44,27 @@ def measure_rms_folder(parent):
     ------
     IOError
         If there is an error reading the audio files.
+    ValueError
+        If the folder contains no readable audio.
 
     """
     paths = os.listdir(parent)
     print(paths[:5])
-    audio = []
+    sum_squares = 0.0
+    n_samples = 0
     for p in paths:
         try:
-            f = sf.read(os.path.join(parent, p))[0]
+            f = sf.read(os.path.join(parent, p), dtype='float32')[0]
             logging.debug(f"File with shape {f.shape} successfully read.")
-            audio.append(f)
         except:
             IOError("Incorrect path.")
             logging.exception(f"Unable to read file {p}")
-    long_array = empty(0)
-    for a in audio:
-        long_array = concatenate([long_array, a])
-    rms = sqrt(mean(long_array**2))
+            continue
+        sum_squares += (f*f).sum(dtype=np.float64)
+        n_samples += f.size
+    if n_samples == 0:
+        raise ValueError(f"No readable audio found in folder {parent}")
+    rms = sqrt(sum_squares / n_samples)
     return rms
 
 def prepare_noise(rms_material, length=5, fs=44100):
@@ -80,15 +83,17 @@ def prepare_noise(rms_material, length=5, fs=44100):
     Returns
     -------
     numpy.ndarray
-        The generated white noise, normalized to the desired RMS value.
+        The generated float32 white noise, normalized to the desired RMS value.
     """
-    white_noise = uniform(-1, 1, length*fs)
-    rms_noise = sqrt(mean(white_noise**2))
-    print(rms_noise.shape)
-    white_noise_audio_norm = white_noise * rms_material/rms_noise
-    rms_white_noise_an = sqrt(mean(white_noise_audio_norm**2))
-    logging.debug(f"audio (RMS): {rms_material:.3f}, noise (RMS): {rms_noise:.3f}, normalized noise (RMS): {rms_white_noise_an:.3f}")
-    return white_noise_audio_norm
+    rng = np.random.default_rng()
+    white_noise = rng.random(length*fs, dtype=np.float32)
+    white_noise *= 2
+    white_noise -= 1
+    # dot product avoids the squared temporary, scaling is done in place
+    rms_noise = sqrt(np.dot(white_noise, white_noise) / white_noise.size)
+    white_noise *= rms_material/rms_noise
+    logging.debug(f"audio (RMS): {rms_material:.3f}, noise (RMS): {rms_noise:.3f}")
+    return white_noise
 
 def button_load_clicked(str_var_parrent: StringVar, noise: Noise, button: CTkButton):
     """Load button click event handler.
@@ -96,7 +101,7 @@ def button_load_clicked(str_var_parrent: StringVar, noise: Noise, button: CTkBut
     This function is called when the load button is clicked. It performs the following steps:
     1. Measures the RMS of the folder specified by the parent string variable.
     2. Prepares the mono noise using the measured RMS material.
-    3. Initializes the stereo noise arrays with zeros.
+    3. Initializes the (frames, 2) stereo noise arrays with zeros.
     4. Assigns the mono noise to the left and right channels of the stereo noise arrays.
     5. Configures the button's foreground and hover colors to green.
 
@@ -111,13 +116,11 @@ def button_load_clicked(str_var_parrent: StringVar, noise: Noise, button: CTkBut
     """
     rms_material = measure_rms_folder(parent=str_var_parrent.get())
     noise.noise_mono = prepare_noise(rms_material=rms_material)
-    zeros_stereo = zeros((2, noise.noise_mono.shape[0]))
-    noise.noise_L = zeros_stereo.copy()
-    noise.noise_L[0] = noise.noise_mono
-    noise.noise_L = noise.noise_L.T
-    noise.noise_R = zeros_stereo.copy()
-    noise.noise_R[1] = noise.noise_mono
-    noise.noise_R = noise.noise_R.T
+    n = noise.noise_mono.shape[0]
+    noise.noise_L = zeros((n, 2), dtype=np.float32)
+    noise.noise_L[:, 0] = noise.noise_mono
+    noise.noise_R = zeros((n, 2), dtype=np.float32)
+    noise.noise_R[:, 1] = noise.noise_mono
     button.configure(fg_color="green", hover_color="green")
 
 def button_play_noise(noise: Noise, ch: str, corr_db: float, fs=44100):
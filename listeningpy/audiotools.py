@@ -5,6 +5,27 @@ import pyloudnorm as pyln
 import numpy as np
 import soundfile as sf
 import os
+from functools import lru_cache
+
+@lru_cache(maxsize=8)
+def get_meter(fs: int) -> pyln.Meter:
+    """
+    Return a shared ITU-R BS.1770 loudness meter.
+
+    Creating a meter designs its filters, so one meter is kept per
+    sample rate and reused by all the callers.
+
+    Parameters
+    ----------
+    fs : int
+        The sample rate of the audio signal.
+
+    Returns
+    -------
+    pyloudnorm.Meter
+        The loudness meter.
+    """
+    return pyln.Meter(fs)
 
 def audio_stats(audio: np.ndarray, fs: int):
     """
@@ -22,9 +43,11 @@ def audio_stats(audio: np.ndarray, fs: int):
     tuple
         A tuple containing the peak amplitude, RMS amplitude, and integrated loudness of the audio signal.
     """
-    peak = 20*np.log10(abs(audio).max())
-    rms = 20*np.log10(np.sqrt(np.mean(audio**2)))
-    meter = pyln.Meter(fs)
+    # reductions without the abs(audio) and audio**2 temporaries
+    peak = 20*np.log10(max(audio.max(), -audio.min()))
+    mean_sq = np.vdot(audio, audio) / audio.size
+    rms = 10*np.log10(mean_sq)
+    meter = get_meter(fs)
     loudness = meter.integrated_loudness(audio)
     return peak, rms, loudness
 
@@ -32,7 +55,8 @@ def write_audio(
         audio: np.ndarray, 
         fs: int, 
         destination: str, 
-        filename: str
+        filename: str,
+        subtype: str = None
         ) -> None:
     """
     Write audio data to a file.
@@ -47,11 +71,17 @@ def write_audio(
         The destination directory where the file will be saved.
     filename : str
         The name of the file.
+    subtype : str, optional
+        The soundfile subtype, e.g. 'PCM_24'. The format default is used
+        if not provided.
 
     Returns
     -------
     None
     """
-    if not os.path.exists(destination):
-        os.makedirs(destination)
-    sf.write(os.path.join(destination, filename), audio, fs)
\ No newline at end of file
+    os.makedirs(destination, exist_ok=True)
+    channels = audio.shape[1] if audio.ndim == 2 else 1
+    with sf.SoundFile(
+            os.path.join(destination, filename), 'w', fs, channels,
+            subtype=subtype) as wf:
+        wf.write(audio)
\ No newline at end of file
@@ -3,14 +3,19 @@ This module contains functions for reading and parsing configuration files.
 """
 import configparser
 import logging
-from typing import Dict
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Mapping
 
 
 
-def person_identifiers(path: str) -> Dict[str, str]:
+def person_identifiers(path: str) -> Mapping[str, str]:
     """
     Read a configuration file and extract person identifiers.
 
+    The result is cached per path, use `person_identifiers.cache_clear()`
+    to read a changed file again. Failed reads are not cached.
+
     Parameters
     ----------
     path : str
@@ -18,8 +23,21 @@ def person_identifiers(path: str) -> Dict[str, str]:
 
     Returns
     -------
-    dict
-        A dictionary containing person identifiers.
+    Mapping
+        A read-only mapping containing person identifiers, empty if the
+        config file cannot be read.
+    """
+    try:
+        return _read_identifiers(path)
+    except IOError as err:
+        logging.warning(f'{err} ({path})')
+        return MappingProxyType({})
+
+@lru_cache(maxsize=4)
+def _read_identifiers(path: str) -> Mapping[str, str]:
+    """
+    Cached reader of `person_identifiers`, raises instead of returning
+    partial identifiers so that only complete reads are cached.
 
     Raises
     ------
@@ -42,10 +60,11 @@ def person_identifiers(path: str) -> Dict[str, str]:
             person_dict['date_of_birth_day'] = cfg.get('Identifiers', 'Gender')
         if 'HearingImpaired' in keys:
             person_dict['hear_impaired'] = cfg.get('Identifiers', 'HearingImpaired')
-    except:
-        IOError('Something went wrong while reading config file.')
-    return person_dict
+    except Exception as err:
+        raise IOError('Something went wrong while reading config file.') from err
+    return MappingProxyType(person_dict)
 
+person_identifiers.cache_clear = _read_identifiers.cache_clear
 
 
 def test_settings(path: str) -> Dict[str, str]:
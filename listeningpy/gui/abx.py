@@ -4,6 +4,8 @@ This module defines the `Abx` class, which represents a basic ABX test window wi
 
 import customtkinter as ctk
 import time
+from functools import partial
+import numpy as np
 from pandas import DataFrame
 import logging
 import listeningpy.gui.gui as gui
@@ -13,6 +15,9 @@ from typing import Callable
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("dark-blue")
 
+LOG_COLUMNS = ['idx', 'stimulus_0', 'stimulus_1', 'reference',
+               'right_choice', 'clicks', 'time']
+
 class Abx(ctk.CTkFrame):
     '''A basic ABX test window with a counter
 
@@ -42,7 +47,9 @@ class Abx(ctk.CTkFrame):
                 master : ctk.CTk,
                 combinations: DataFrame,
                 processing_func : Callable=straight,
-                *args, **kwargs
+                *args,
+                log_path : str=None,
+                **kwargs
                 ):
         """Initialize the ABX GUI.
 
@@ -54,19 +61,37 @@ class Abx(ctk.CTkFrame):
             The combinations of stimuli.
         processing_func : Callable, optional
             The processing function to apply, by default straight.
+        log_path : str, optional
+            Path to an SQLite database where every response is logged
+            as soon as it is given, by default None (no logging).
         *args, **kwargs : 
             Additional arguments and keyword arguments.
         """
         ctk.CTkFrame.__init__(self, master)
         self.combinations = combinations
         self.last_idx = combinations.index[-1]
+        self._cols = {
+            c: combinations[c].to_numpy() for c in ('0', '1', 'Ref')
+            }
+        # in line with radio button values
+        self._right = np.where(self._cols['0'] == self._cols['Ref'], '0', '1')
+        # responses are collected here and stored to combinations when
+        # the frame is destroyed, also when the window is closed early
+        self._responses = np.full((self.last_idx+1, 3), np.nan)
+        self._log = None
+        if log_path is not None:
+            self._log = gui.open_response_log(log_path, 'abx', LOG_COLUMNS)
+        self._cache = gui.StimulusCache(
+            combinations[['0', '1', 'Ref']].to_numpy().ravel()
+            )
         self.processing_func = processing_func
         self.kwargs = kwargs
         self.choice = ctk.StringVar()
         self.progress = ctk.IntVar()
         self.progress.set(0)
         self.progress_label_var = ctk.StringVar()
-        self.progress_label_var.set(f"{self.progress.get()+1}/{self.last_idx+1}")
+        self._labels = [f"{i+1}/{self.last_idx+1}" for i in range(self.last_idx+1)]
+        self.progress_label_var.set(self._labels[self.progress.get()])
 
         self.question = ctk.CTkLabel(self, 
             text="Which stimulus is the same as reference?")
@@ -83,25 +108,11 @@ class Abx(ctk.CTkFrame):
 
         self.button_a = gui.PlayButton(self, 
             text="A", 
-            command=lambda:gui.play_click(
-                combinations.loc[self.progress.get(), '0'],
-                button=self.button_a,
-                next_buttons=[self.button_b],
-                processing_func=self.processing_func,
-                **self.kwargs
-                ), 
             state=ctk.NORMAL)
         self.button_a.grid(row=1, column=0, columnspan=1, 
             padx=20, pady=10)
 
         self.button_b = gui.PlayButton(self, text="B", 
-            command=lambda: gui.play_click(
-                combinations.loc[self.progress.get(), '1'],
-                button=self.button_b,
-                next_buttons=[self.button_ref],
-                processing_func=self.processing_func,
-                **self.kwargs
-                ),
             state=ctk.DISABLED)
         self.button_b.grid(row=2, column=0, columnspan=1,
             padx=20,
@@ -132,13 +143,6 @@ class Abx(ctk.CTkFrame):
         self.button_ref = gui.PlayButton(self, 
             text="Reference", 
             width=202, 
-            command=lambda:gui.play_click(
-                combinations.loc[self.progress.get(), "Ref"],
-                self.button_ref,
-                [self.choice_A, self.choice_B],
-                processing_func=self.processing_func,
-                **self.kwargs
-                ),
             state=ctk.DISABLED)
         self.button_ref.grid(row=3, column=0, columnspan=2, 
             padx=20, 
@@ -155,6 +159,15 @@ class Abx(ctk.CTkFrame):
             pady=10
             )
 
+        self.button_a.configure(command=partial(
+            self._on_play, '0', self.button_a, [self.button_b]
+            ))
+        self.button_b.configure(command=partial(
+            self._on_play, '1', self.button_b, [self.button_ref]
+            ))
+        self.button_ref.configure(command=partial(
+            self._on_play, 'Ref', self.button_ref, [self.choice_A, self.choice_B]
+            ))
         self.choice_A.configure(
             command=lambda: gui.check_choice(self.button_b, self.button_next)
             )
@@ -162,6 +175,46 @@ class Abx(ctk.CTkFrame):
             command=lambda: gui.check_choice(self.button_b, self.button_next)
             )
     
+    def _on_play(self, col, button, next_buttons):
+        '''Plays the stimulus of the given column for the current set.
+
+        Parameters
+        ----------
+        col : str
+            column of combinations, '0', '1' or 'Ref'
+        button : gui.PlayButton
+            the clicked button
+        next_buttons : list[ctk.CTkButton, ctk.CTkRadioButton]
+            list of buttons to be enabled after click
+        '''
+        gui.play_click(
+            self._cols[col][self.progress.get()],
+            button=button,
+            next_buttons=next_buttons,
+            processing_func=self.processing_func,
+            cache=self._cache,
+            **self.kwargs
+            )
+
+    def destroy(self):
+        '''Stores the responses given so far, closes the response log
+        and releases the stimulus cache together with the frame.'''
+        self._write_responses()
+        if self._log is not None:
+            self._log.close()
+        self._cache.close()
+        ctk.CTkFrame.destroy(self)
+
+    def _write_responses(self):
+        '''Writes the collected responses to self.combinations, sets
+        without a response are left NaN.'''
+        cols = ["Right choice", "Clicks", "Time"]
+        self.combinations[cols] = DataFrame(
+            self._responses,
+            index=range(self.last_idx+1),
+            columns=cols
+            )
+
     def right_answer(self):
         '''Checks which answer is correct for each set.
 
@@ -170,12 +223,7 @@ class Abx(ctk.CTkFrame):
         column : str
             the right answer column name
         '''
-        a = self.combinations.loc[self.progress.get(), '0']
-        ref = self.combinations.loc[self.progress.get(), "Ref"]
-        if a == ref:
-            return '0' # this is in line with radio button values
-        else:
-            return '1'
+        return self._right[self.progress.get()]
         
     def store_response(self):
         '''Returns response, number of clicks and time
@@ -215,16 +263,26 @@ class Abx(ctk.CTkFrame):
         return right_choice, clicks, t
     
     def move_to_next(self):
-        '''Stores response to self.combinations dataframe and moves
-        to the next set.
+        '''Stores response and moves to the next set. The responses
+        are written to self.combinations dataframe after the last set
+        or when the window is closed.
 
         '''
         row = self.progress.get()
-        cols = ["Right choice", "Clicks", "Time"]
-        right_choice, clicks, t = self.store_response()
-        self.combinations.loc[row, cols] = [right_choice, clicks, t]
+        self._responses[row] = self.store_response()
+        if self._log is not None:
+            right_choice, clicks, t = self._responses[row]
+            gui.log_response(self._log, 'abx', (
+                row,
+                str(self._cols['0'][row]),
+                str(self._cols['1'][row]),
+                str(self._cols['Ref'][row]),
+                int(right_choice), int(clicks), float(t)
+                ))
         if self.progress.get() > self.last_idx:
+            self._write_responses()
             self.master.destroy()
-        self.progress_label_var.set(f"{self.progress.get()+1}/{self.last_idx+1}")
+            return
+        self.progress_label_var.set(self._labels[self.progress.get()])
         # logging.info(self.combinations.loc[row, :])
     
\ No newline at end of file
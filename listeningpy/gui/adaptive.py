@@ -26,6 +26,7 @@ processing_func : Callable, optional
 """
 import customtkinter as ctk
 import time
+import numpy as np
 import pandas as pd
 import logging
 import listeningpy.gui.gui as gui
@@ -36,6 +37,29 @@ ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("dark-blue")
 # ctk.set_widget_scaling(2)
 
+LOG_COLUMNS = ['set_id', 'idx', 'path', 'answer', 'ir_id']
+
+def finalize_responses(responses: list[pd.DataFrame]) -> pd.DataFrame:
+    '''Concatenates the responses collected by Adaptive frames.
+
+    The master window can keep its ``responses`` attribute as a list,
+    to which every finished set is appended. This function should be
+    called once at the end of the test.
+
+    Parameters
+    ----------
+    responses : list[pandas.DataFrame]
+        responses of the individual sets
+
+    Returns
+    -------
+    responses : pandas.DataFrame
+        all the responses in a single dataframe
+    '''
+    if not responses:
+        return pd.DataFrame()
+    return pd.concat(responses, ignore_index=True)
+
 class Adaptive(ctk.CTkFrame):
     '''A basic Adaptive test window for convolution based processing.
 
@@ -61,7 +85,9 @@ class Adaptive(ctk.CTkFrame):
                 set_id: str = None,
                 initial_difficulty: int = -1,
                 processing_func : Callable = straight,
-                *args, **kwargs
+                *args,
+                log_path : str = None,
+                **kwargs
                 ):
             """Initialize the AdaptiveGUI class.
 
@@ -79,21 +105,42 @@ class Adaptive(ctk.CTkFrame):
                 The index of the initial difficulty level. Default is -1.
             processing_func : Callable, optional
                 The processing function to be used. Default is straight.
+            log_path : str, optional
+                Path to an SQLite database where every response is logged
+                as soon as it is given. Default is None (no logging).
             *args, **kwargs
                 Additional arguments and keyword arguments 
                 associated with the processing function.
             """
             ctk.CTkFrame.__init__(self, master)
             self.sets = sets
+            self._by_set = {
+                k: g.reset_index(drop=True)
+                for k, g in self.sets.groupby('set', sort=False)
+                }
             self.irs = irs
+            # decode all the IRs once, play() only picks one by position
+            self._irs_audio = [
+                read(p, always_2d=True, dtype='float32') for p in self.irs['path']
+                ]
             self.set_id = set_id
             if self.set_id is not None:
-                self.current_set = self.sets[self.sets['set'] == set_id]
+                self.current_set = self._by_set[set_id]
             else:
                 self.current_set = self.sets
+            self._paths = self.current_set['path'].to_numpy()
+            self._trans = self.current_set['transcription'].to_numpy()
+            self._cache = gui.StimulusCache(self._paths)
+            self._irs_id = self.irs['id'].to_numpy()
             self.initial_difficulty = initial_difficulty
-            self.difficulty = self.irs.index[initial_difficulty]
+            # positional index into irs, kept within its bounds
+            self.difficulty = initial_difficulty % len(self.irs)
             self.last_idx = self.current_set.index[-1]
+            self._labels = [f"{i+1}" for i in range(self.last_idx+1)]
+            self._reset_responses()
+            self._log = None
+            if log_path is not None:
+                self._log = gui.open_response_log(log_path, 'adaptive', LOG_COLUMNS)
             self.processing_func = processing_func
             self.kwargs = kwargs
 
@@ -101,9 +148,9 @@ class Adaptive(ctk.CTkFrame):
             self.progress = ctk.IntVar()
             self.progress.set(0)
             self.progress_label_var = ctk.StringVar()
-            self.progress_label_var.set(f"{self.progress.get()+1}")
+            self.progress_label_var.set(self._labels[self.progress.get()])
             self.current_sentence = ctk.StringVar()
-            self.current_sentence.set(self.current_set["transcription"].iloc[self.progress.get()])
+            self.current_sentence.set(self._trans[self.progress.get()])
 
             self.label_set = ctk.CTkLabel(self, textvariable=self.progress_label_var)
             self.label_set.grid(row=0, column=2, columnspan=1, 
@@ -171,7 +218,7 @@ class Adaptive(ctk.CTkFrame):
         """
         Plays the audio file with adaptive settings.
 
-        This method reads the impulse response (IR) file based on the current difficulty level,
+        This method picks the preloaded impulse response (IR) based on the current difficulty level,
         and then plays the audio file with the specified processing function and additional arguments.
 
         Args:
@@ -180,13 +227,14 @@ class Adaptive(ctk.CTkFrame):
         Returns:
             None
         """
-        ir, fs_ir = read(self.irs['path'].iloc[self.difficulty], always_2d=True)
+        ir, fs_ir = self._irs_audio[self.difficulty]
         print(self.kwargs.keys())
         gui.play_click(
-            self.current_set.loc[self.progress.get(), "path"],
+            self._paths[self.progress.get()],
             button=self.button_play,
             next_buttons=[self.segmented_button, self.button_next],
             processing_func=self.processing_func,
+            cache=self._cache,
             in2 = ir,
             fs_in2 = fs_ir,
             **self.kwargs)
@@ -221,42 +269,75 @@ class Adaptive(ctk.CTkFrame):
         self.button_next.configure(state=ctk.DISABLED)
 
     def move_to_next(self):
-        '''Stores response to self.current_set dataframe and moves
-        to the next set.
+        '''Stores response and moves to the next set. The responses
+        are written to self.current_set dataframe after the last set.
         '''
         row = self.progress.get()
-        cols = ["answer", "ir_id"]
-        self.current_set.loc[row, cols] = [self.choice.get(), self.irs["id"].iloc[self.difficulty]]
         
         if self.choice.get() == "Correct":
-            self.current_set.loc[row, cols] = [1, self.irs["id"].iloc[self.difficulty]]
-            self.difficulty = self.difficulty + 1
+            self._answers[row] = 1
+            self._ir_ids[row] = self._irs_id[self.difficulty]
+            self.difficulty = min(len(self._irs_id)-1, self.difficulty+1)
             self.progress.set(self.progress.get()+1)
         elif self.progress.get() != 0:
-            self.current_set.loc[row, cols] = [0, self.irs["id"].iloc[self.difficulty]]
-            self.difficulty = self.difficulty - 1
+            self._answers[row] = 0
+            self._ir_ids[row] = self._irs_id[self.difficulty]
+            self.difficulty = max(0, self.difficulty-1)
             self.progress.set(self.progress.get()+1)
         else:
-            self.difficulty = self.difficulty - 1
+            self.difficulty = max(0, self.difficulty-1)
+
+        if self._log is not None and self.progress.get() > row:
+            gui.log_response(self._log, 'adaptive', (
+                str(self.set_id), row, str(self._paths[row]),
+                int(self._answers[row]), str(self._ir_ids[row])
+                ))
 
         print(f"Difficulty: {self.difficulty}\nSentence: {self.progress.get()}")
         self.reset_buttons()
         if self.progress.get() > self.last_idx:
-            self.master.responses = pd.concat(
-                [self.master.responses, self.current_set]
-            )
+            self.current_set = self.current_set.assign(
+                answer=pd.Series(self._answers, index=range(self.last_idx+1)),
+                ir_id=pd.Series(self._ir_ids, index=range(self.last_idx+1))
+                )
+            # a list of per-set frames is concatenated only once by
+            # finalize_responses, older masters keep a single DataFrame
+            if isinstance(self.master.responses, list):
+                self.master.responses.append(self.current_set)
+            else:
+                self.master.responses = pd.concat(
+                    [self.master.responses, self.current_set]
+                )
             self.master.switch_frame(self.master.intermediate_frame)
             return
-        self.progress_label_var.set(f"{self.progress.get()+1}")
-        self.current_sentence.set(self.current_set["transcription"].iloc[self.progress.get()])
+        self.progress_label_var.set(self._labels[self.progress.get()])
+        self.current_sentence.set(self._trans[self.progress.get()])
         # logging.info(self.current_set)
     
     def load_sentences(self):
         """Load the sentences from the given path.
         """
-        self.current_set = self.sets[self.sets['set'] == self.set_id].reset_index(drop=True)
+        self.current_set = self._by_set[self.set_id]
+        self._paths = self.current_set['path'].to_numpy()
+        self._trans = self.current_set['transcription'].to_numpy()
+        self._cache.close()
+        self._cache = gui.StimulusCache(self._paths)
         print("===Current set:===", self.current_set)
+        # sets may differ in length, the buffers and labels follow the new one
+        self.last_idx = self.current_set.index[-1]
+        self._labels = [f"{i+1}" for i in range(self.last_idx+1)]
         self.progress.set(0)
-        self.progress_label_var.set(f"{self.progress.get()+1}")
-        self.difficulty = self.irs.index[self.initial_difficulty]
-        self.current_sentence.set(self.current_set["transcription"].iloc[self.progress.get()])
\ No newline at end of file
+        self.progress_label_var.set(self._labels[self.progress.get()])
+        self.difficulty = self.initial_difficulty % len(self.irs)
+        self._reset_responses()
+        self.current_sentence.set(self._trans[self.progress.get()])
+
+    def destroy(self):
+        """Releases the stimulus cache together with the frame."""
+        self._cache.close()
+        ctk.CTkFrame.destroy(self)
+
+    def _reset_responses(self):
+        """Allocate the buffers collecting answers and IR ids of a set."""
+        self._answers = np.full(self.last_idx+1, np.nan)
+        self._ir_ids = np.empty(self.last_idx+1, dtype=object)
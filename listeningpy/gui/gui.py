@@ -4,10 +4,15 @@ This module contains the GUI classes for the listeningpy package.
 import customtkinter as ctk
 import time
 import logging
+import re
 from typing import Callable
 from numpy import ndarray
 # logging.basicConfig(level=logging.INFO)
 import configparser
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from soundfile import read
 
 import sys
 from listeningpy.stimuli import play_sound
@@ -21,20 +26,115 @@ class PlayButton(ctk.CTkButton):
     parent
         parent customtkinter widget    
 
+    enabled : bool
+        cached state of the button, kept in sync by configure()
+
     Methods
     -------
     reset_count()
         Resets the click counter variable to 0.
     '''
     def __init__(self, parent, *args, **kwargs):
+        self.enabled = kwargs.get('state', ctk.NORMAL) == ctk.NORMAL
         ctk.CTkButton.__init__(self, parent, *args, **kwargs)
         self.click_count = 0
+        self.time = 0.0
     
     def reset_count(self):
         self.click_count = 0
 
+    def configure(self, *args, **kwargs):
+        if 'state' in kwargs:
+            self.enabled = kwargs['state'] == ctk.NORMAL
+        ctk.CTkButton.configure(self, *args, **kwargs)
+
+class StimulusCache:
+    '''Decodes stimuli in background threads and keeps them in memory.
+
+    The files are read while the participant is busy with the GUI, so
+    clicking a playback button does not wait for the disk. Stimuli
+    following the requested one in `paths` are read ahead, the least
+    recently used ones are dropped above `max_entries`.
+
+    Parameters
+    ----------
+    paths : iterable[str]
+        paths to the stimuli in the order they are expected to be played
+    max_entries : int, optional
+        number of decoded stimuli kept in memory, by default 32
+    ahead : int, optional
+        number of stimuli read ahead, by default 8
+    max_workers : int, optional
+        number of reading threads, by default 4
+
+    Methods
+    -------
+    get(path)
+        Returns a copy of the decoded stimulus and its sample rate.
+    close()
+        Stops the reading threads and drops the decoded stimuli.
+    '''
+    def __init__(
+            self,
+            paths,
+            max_entries: int=32,
+            ahead: int=8,
+            max_workers: int=4
+            ):
+        self._paths = list(dict.fromkeys(paths))
+        self._order = {p: i for i, p in enumerate(self._paths)}
+        self.max_entries = max_entries
+        self.ahead = min(ahead, max_entries-1)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = OrderedDict()
+        for p in self._paths[:self.ahead]:
+            self._submit(p)
+
+    def _submit(self, path: str):
+        '''Returns the future of a stimulus, reading it if not cached.'''
+        if path in self._futures:
+            self._futures.move_to_end(path)
+        else:
+            self._futures[path] = self._executor.submit(
+                read, path, always_2d=True, dtype='float32')
+        future = self._futures[path]
+        # the oldest finished reads are dropped, pending ones are kept
+        while len(self._futures) > self.max_entries:
+            done = next((p for p, f in self._futures.items() if f.done()), None)
+            if done is None:
+                break
+            del self._futures[done]
+        return future
+
+    def get(self, path: str) -> tuple[ndarray, int]:
+        i = self._order.get(path)
+        if i is not None:
+            for p in self._paths[i+1:i+1+self.ahead]:
+                self._submit(p)
+        sound, fs = self._submit(path).result()
+        # processing functions may work in place
+        return sound.copy(), fs
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._futures.clear()
+
 class InitFrame(ctk.CTkFrame):
-    def __init__(self, master, test_frame, cfg_file=None, *args, **kwargs):
+    '''Initial frame collecting the participant identifiers.
+
+    Parameters
+    ----------
+    master : ctk.CTk
+        The master widget.
+    test_frame : ctk.CTkFrame
+        The frame representing the test.
+    cfg_file : str, optional
+        Path to a config file with the identifiers, parsed on creation.
+    cfg : dict, optional
+        Identifiers already read by `listeningpy.config.person_identifiers`,
+        takes precedence over cfg_file.
+    '''
+    def __init__(self, master, test_frame, cfg_file=None, *args, cfg=None, **kwargs):
         ctk.CTkFrame.__init__(self, master, *args, **kwargs)
         self.test_frame = test_frame
         self.first_name = str
@@ -82,8 +182,10 @@ class InitFrame(ctk.CTkFrame):
             onvalue=True, 
             offvalue=False)
 
-        if cfg_file is not None:
-            self.set_identifiers(cfg_file)
+        if cfg is None and cfg_file is not None:
+            cfg = person_identifiers(cfg_file)
+        if cfg is not None:
+            self.set_identifiers(cfg)
 
         self.start_button = ctk.CTkButton(self, text='Start test', command=self.button_clicked)
 
@@ -141,8 +243,7 @@ class InitFrame(ctk.CTkFrame):
             padx=10,
             pady=5)
     
-    def set_identifiers(self, cfg_file):
-        identifiers = person_identifiers(cfg_file)
+    def set_identifiers(self, identifiers):
         keys = identifiers.keys()
         if 'first_name' in keys:
                 self.first_name = identifiers['first_name']
@@ -152,16 +253,25 @@ class InitFrame(ctk.CTkFrame):
             self.second_name_entry.insert(0, self.second_name)
         if 'date_of_birth' in keys:
             self.date_of_birth = identifiers['date_of_birth']
-            self.date_of_birth_day_entry.insert(0, self.date_of_birth[:2])
-            self.date_of_birth_month_entry.insert(0, self.date_of_birth[3:5])
-            self.date_of_birth_year_entry.insert(0, self.date_of_birth[6:10])
+            # any separator is accepted, e.g. 1/2/1990, 01.02.1990
+            parts = re.split(r'\D+', self.date_of_birth.strip())
+            if len(parts) == 3 and all(parts):
+                dd, mm, yyyy = parts
+                self.date_of_birth_day_entry.insert(0, dd)
+                self.date_of_birth_month_entry.insert(0, mm)
+                self.date_of_birth_year_entry.insert(0, yyyy)
+            elif self.date_of_birth.strip():
+                logging.warning(
+                    f"Unrecognized date of birth {self.date_of_birth!r}, "+
+                    "shown unparsed.")
+                self.date_of_birth_day_entry.insert(0, self.date_of_birth)
         if 'gender' in keys:
             self.gender = identifiers['gender']
             self.gender_menu.set(self.gender)
         if 'hear_impaired' in keys:
-            print(identifiers['hear_impaired'])
             self.hear_impaired = identifiers['hear_impaired'].lower() == "true"
-            print(self.hear_impaired)
+            logging.debug("hear_impaired raw=%r parsed=%s",
+                          identifiers['hear_impaired'], self.hear_impaired)
             if self.hear_impaired:
                 self.hear_impaired_toggle.select()
 
@@ -335,8 +445,9 @@ def first_clicked(button: ctk.CTkButton):
     ----------
     button : ctk.CTkButton
     '''
-    if not hasattr(button, 'time') or button.time == 0:
-        button.time = time.time()
+    # plain CTkButtons (e.g. 'Next') get the attribute on the first click
+    if getattr(button, 'time', 0.0) == 0.0:
+        button.time = time.perf_counter()
         logging.info("clicked!")
 
 def stopwatch(
@@ -357,8 +468,8 @@ def stopwatch(
         time between first and last click
     '''
     t = button_end.time-button_start.time
-    button_start.time = 0
-    button_end.time = 0
+    button_start.time = 0.0
+    button_end.time = 0.0
     return t
 
 def play_click(
@@ -366,6 +477,7 @@ def play_click(
         button: PlayButton,
         next_buttons: list[ctk.CTkButton, ctk.CTkRadioButton],
         processing_func: Callable[[ndarray, int], ndarray]=straight,
+        cache: 'StimulusCache'=None,
         **kwargs
         ) -> None:
     '''Defines actions for playback buttons.
@@ -382,13 +494,22 @@ def play_click(
         button just clicked (for counter)
     next_buttons : list[ctk.CTkButton, ctk.CTkRadioButton]
         list of buttons to be enabled after click
+    cache : StimulusCache, optional
+        cache of decoded stimuli, the file is read on click if not provided
     '''
     count_add(button)
     first_clicked(button)
     logging.info(f"Playing {stimuli_path}")
-    play_sound(path=stimuli_path, processing_func=processing_func, **kwargs)
+    if cache is None:
+        play_sound(path=stimuli_path, processing_func=processing_func, **kwargs)
+    else:
+        sound, fs = cache.get(stimuli_path)
+        sound, fs = processing_func(sound, fs, **kwargs)
+        play_sound(sound=sound, fs=fs)
     for n in next_buttons:
-        n.configure(state=ctk.NORMAL)
+        # PlayButtons already enabled by a previous click are not redrawn
+        if not getattr(n, 'enabled', False):
+            n.configure(state=ctk.NORMAL)
 
 def check_choice(
         last_played: PlayButton,
@@ -404,5 +525,55 @@ def check_choice(
     button_end : ctk.CTkButton
         'Next' button
     '''
-    if last_played.cget("state") == ctk.NORMAL:
-        button_end.configure(state=ctk.NORMAL)
\ No newline at end of file
+    if last_played.enabled:
+        button_end.configure(state=ctk.NORMAL)
+
+def open_response_log(
+        path: str,
+        table: str,
+        columns: list[str]
+        ) -> sqlite3.Connection:
+    '''Opens an SQLite database used as an append-only log of responses.
+
+    Each response is committed as soon as it is given, so the data
+    survive a crash of the GUI. The log can be read back with
+    pandas.read_sql(f'SELECT * FROM {table}', connection).
+
+    Parameters
+    ----------
+    path : str
+        path to the database file, created if it does not exist
+    table : str
+        name of the table holding the responses
+    columns : list[str]
+        column names of the table
+
+    Returns
+    -------
+    db : sqlite3.Connection
+    '''
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute(f'CREATE TABLE IF NOT EXISTS {table}({", ".join(columns)})')
+    db.commit()
+    return db
+
+def log_response(
+        db: sqlite3.Connection,
+        table: str,
+        values: tuple
+        ) -> None:
+    '''Appends a single response to the log and commits it.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        connection returned by open_response_log
+    table : str
+        name of the table holding the responses
+    values : tuple
+        one value per column of the table
+    '''
+    placeholders = ', '.join('?' * len(values))
+    db.execute(f'INSERT INTO {table} VALUES({placeholders})', values)
+    db.commit()
@@ -1,16 +1,31 @@
 """
 This module contains functions for normalizing audio signals.
 """
+import math
 import numpy as np
-from scipy.signal import resample
-import pyloudnorm as pyln
+from scipy.signal import resample_poly
+from math import gcd
 import mosqito
 import logging
+from listeningpy.audiotools import get_meter
+
+ZWICKER_EXPONENT = 0.6  # specific loudness ~ pressure**0.6 above threshold
+# N ~ p**0.6 and 10 phon per doubling of N give ~1 phon per dB of gain
+PHON_PER_DB = ZWICKER_EXPONENT / 2 * math.log2(10)
+_LN10_OVER_20 = math.log(10) / 20  # 10**(x/20) == exp(_LN10_OVER_20*x)
+USE_FLOAT32 = True  # process double precision input in single precision
+
+def _as_float32(audio : np.ndarray) -> np.ndarray:
+    """Converts float64 audio to float32 if USE_FLOAT32 is set."""
+    if USE_FLOAT32 and audio.dtype == np.float64:
+        return audio.astype(np.float32)
+    return audio
 
 def fs_to_pressure(
         audio : np.ndarray,
         dbfs_db : float,
-        p0 : float=2e-5):
+        p0 : float=2e-5,
+        out : np.ndarray=None):
     """Converts audio from full-scale (FS) to pressure (Pa).
 
     Parameters
@@ -21,15 +36,43 @@ def fs_to_pressure(
         The sound pressure level associated with 0 dBFS.
     p0 : float, optional
         The reference sound pressure in pascals (Pa), by default 2e-5.
+    out : np.ndarray, optional
+        Buffer to write the result into, may be `audio` itself. A new
+        array is allocated by default.
 
     Returns
     -------
     np.ndarray
         The audio signal converted to pressure (Pa).
     """
-    ratio_db = p0 * 10 ** (dbfs_db/20)
-    audio_pressure = audio * ratio_db
-    return audio_pressure
+    audio = _as_float32(audio)
+    ratio_db = p0 * math.exp(_LN10_OVER_20*dbfs_db)
+    return np.multiply(audio, ratio_db, out=out)
+
+def _mono_48k(
+        audio : np.ndarray, 
+        fs : int) -> np.ndarray:
+    """Averages the channels and resamples the signal to 48 kHz.
+
+    Polyphase filtering is used, 48 kHz input is not resampled.
+
+    Parameters
+    ----------
+    audio : ndarray
+        2-D audio array.
+    fs : int
+        Sampling frequency of the audio signal.
+
+    Returns
+    -------
+    ndarray
+        1-D signal sampled at 48 kHz.
+    """
+    audio = audio.mean(axis=1)
+    if fs != 48000:
+        g = gcd(48000, fs)
+        audio = resample_poly(audio, 48000//g, fs//g)
+    return audio
 
 def eq_loudness_lvl(
         audio_pressure : np.ndarray, 
@@ -38,6 +81,9 @@ def eq_loudness_lvl(
     """
     Calculate the log average loudness level of an audio signal.
 
+    The channels are averaged and the signal is resampled to 48 kHz
+    (see `_mono_48k`) before calling `mosqito.loudness_zwtv`.
+
     Parameters
     ----------
     audio_pressure : ndarray
@@ -54,12 +100,9 @@ def eq_loudness_lvl(
     tuple
         A tuple containing the loudness values and corresponding time values.
     """
-    audio_pressure = audio_pressure.mean(axis=1)
-    audio_pressure = resample(audio_pressure, int(audio_pressure.shape[0]*48000/fs))
-    fs=48000
-    N, N_spec, _, time = mosqito.loudness_zwtv(
-        audio_pressure, 
-        fs, 
+    N, _, _, time = mosqito.loudness_zwtv(
+        _mono_48k(audio_pressure, fs), 
+        48000, 
         field_type=field_type
     )
     loud_lvl = 40 + 10*np.log2(N.mean())
@@ -69,7 +112,8 @@ def peak_normalize(
         audio : np.ndarray, 
         fs : int, 
         peak : float=0, 
-        reference : np.ndarray=None
+        reference : np.ndarray=None,
+        out : np.ndarray=None
         ) -> tuple[np.ndarray, float]:
     """
     Normalize the peak level of an audio signal.
@@ -82,8 +126,12 @@ def peak_normalize(
         The sample rate of the audio signal.
     peak : float, optional
         The desired peak level in decibels (dB), by default 0.
-    reference : np.ndarray, optional
-        The reference audio signal for normalization, by default None.
+    reference : np.ndarray or float, optional
+        The reference audio signal for normalization, or its already
+        computed linear peak value, by default None.
+    out : np.ndarray, optional
+        Buffer to write the normalized audio into, may be `audio` itself
+        to normalize in place. A new array is allocated by default.
 
     Returns
     -------
@@ -97,17 +145,23 @@ def peak_normalize(
     If no reference signal is provided, the normalization is performed relative to the peak level of the input audio signal itself.
     The normalization factor is calculated based on the desired peak level and the maximum absolute value of the reference signal.
     """
-    if type(reference) == type(None):
+    audio = _as_float32(audio)
+    if reference is None:
         reference = audio
-    factor = 10**(peak/20) / abs(reference).max()
+    if np.isscalar(reference):
+        ref_peak = reference
+    else:
+        ref_peak = max(reference.max(), -reference.min())
+    factor = math.exp(_LN10_OVER_20*peak) / ref_peak
     logging.info(f'Stimuli was peak normalized to {peak:.1f} dB')
-    return audio * factor, fs
+    return np.multiply(audio, factor, out=out), fs
 
 def rms_normalize(
         audio : np.ndarray, 
         fs : int, 
         rms : float=-9, 
-        reference : np.ndarray=None
+        reference : np.ndarray=None,
+        out : np.ndarray=None
         ) -> tuple[np.ndarray, float]:
     """
     Normalize the audio signal to a target RMS level.
@@ -120,8 +174,12 @@ def rms_normalize(
         The sample rate of the audio signal.
     rms : float, optional
         The target RMS level in decibels (dB), by default -9 dB.
-    reference : np.ndarray, optional
-        The reference audio signal used for normalization, by default None.
+    reference : np.ndarray or float, optional
+        The reference audio signal used for normalization, or its already
+        computed linear RMS value, by default None.
+    out : np.ndarray, optional
+        Buffer to write the normalized audio into, may be `audio` itself
+        to normalize in place. A new array is allocated by default.
 
     Returns
     -------
@@ -135,17 +193,25 @@ def rms_normalize(
     If no reference signal is provided, the normalization is performed relative to the RMS level of the input audio signal.
     The resulting normalized audio signal is multiplied by a scaling factor to achieve the target RMS level.
     """
-    if type(reference) == type(None):
+    audio = _as_float32(audio)
+    if reference is None:
         reference = audio
-    factor = 10**(rms/20) / np.sqrt(np.mean(reference**2))
+    # vdot flattens and reduces in one pass without the squared temporary
+    if np.isscalar(reference):
+        ref_rms = reference
+    else:
+        mean_sq = np.vdot(reference, reference) / reference.size
+        ref_rms = np.sqrt(mean_sq)
+    factor = math.exp(_LN10_OVER_20*rms) / ref_rms
     logging.info(f'Stimuli was normalized to RMS average of {rms:.1f} dB')
-    return audio * factor, fs
+    return np.multiply(audio, factor, out=out), fs
 
 def lufs_normalize(
         audio : np.ndarray, 
         fs : int, 
         lufs : float=-16, 
-        reference : np.ndarray=None
+        reference : np.ndarray=None,
+        out : np.ndarray=None
         ) -> tuple[np.ndarray, int]:
     """Normalize the loudness of an audio signal to a target LUFS level.
 
@@ -159,26 +225,47 @@ def lufs_normalize(
         The target loudness level in LUFS (Loudness Units Full Scale). Default is -16 LUFS.
     reference : np.ndarray, optional
         The reference audio signal to calculate the loudness. If not provided, the input audio signal is used as the reference.
+    out : np.ndarray, optional
+        Buffer to write the normalized audio into, may be `audio` itself
+        to normalize in place. A new array is allocated by default.
 
     Returns
     -------
     tuple[np.ndarray, int]
         A tuple containing the normalized audio signal as a NumPy array and the sample rate as an int.
     """
-    if type(reference) == type(None):
+    audio = _as_float32(audio)
+    if reference is None:
         reference = audio
-    meter = pyln.Meter(fs)
+    meter = get_meter(fs)
     loudness = meter.integrated_loudness(reference)
     delta = lufs - loudness
-    factor = 10**(delta/20)
+    factor = math.exp(_LN10_OVER_20*delta)
     logging.info(f'Stimuli was loudness normalized to {lufs:.1f} dB LUFS')
-    return audio * factor, fs
+    return np.multiply(audio, factor, out=out), fs
+
+def ir_l1_norm(ir : np.ndarray) -> float:
+    """Returns the sum of the absolute values of the impulse response.
+
+    Parameters
+    ----------
+    ir : np.ndarray
+        The impulse response (IR) signal.
+
+    Returns
+    -------
+    float
+        The sum of the absolute values of all IR samples.
+    """
+    return float(np.abs(ir).sum())
 
 def ir_sum_normalize(
         audio : np.ndarray, 
         ir : np.ndarray, 
         fs : int, 
-        ir_sum : float=-9):
+        ir_sum : float=-9,
+        out : np.ndarray=None,
+        ir_l1 : float=None):
     """Normalize the audio based on the sum of the impulse response (IR).
 
     This function normalizes the given audio signal based on the sum of the absolute values of the impulse response (IR).
@@ -195,6 +282,13 @@ def ir_sum_normalize(
         The sampling rate of the audio signal.
     ir_sum : float, optional
         The desired sum of the IR in decibels (dB), by default -9.
+    out : np.ndarray, optional
+        Buffer to write the normalized audio into, may be `audio` itself
+        to normalize in place. A new array is allocated by default.
+    ir_l1 : float, optional
+        Precomputed sum of the absolute values of the IR (see `ir_l1_norm`),
+        useful when the same IR normalizes many stimuli. Computed from
+        `ir` by default.
 
     Returns
     -------
@@ -203,35 +297,88 @@ def ir_sum_normalize(
     int
         The sampling rate of the normalized audio signal.
     """
-    factor = 10**(ir_sum/20) / abs(ir).sum()
+    audio = _as_float32(audio)
+    if ir_l1 is None:
+        ir_l1 = ir_l1_norm(ir)
+    factor = math.exp(_LN10_OVER_20*ir_sum) / ir_l1
     logging.info(f'Stimuli was normalized based IR sum to {ir_sum:.1f} dB')
-    return audio * factor, fs
+    return np.multiply(audio, factor, out=out), fs
 
 def zwicker_loudness_normalize(
         audio : np.ndarray,
         fs : int,
         target_phon : float,
         dbfs_db: float,
-        return_ratio: bool = False
+        return_ratio: bool = False,
+        max_iter: int = 3
         ) -> tuple[np.ndarray, int]:
-    audio_pressure = fs_to_pressure(audio, dbfs_db)
-    loud_lvl, loudness = eq_loudness_lvl(audio_pressure, fs)
+    """Normalize the audio to a target Zwicker loudness level.
+
+    Parameters
+    ----------
+    audio : np.ndarray
+        The input audio signal, scaled in place.
+    fs : int
+        The sample rate of the audio signal.
+    target_phon : float
+        The target loudness level in phons.
+    dbfs_db : float
+        The sound pressure level associated with 0 dBFS.
+    return_ratio : bool, optional
+        If True, the normalization factor is returned as well,
+        by default False.
+    max_iter : int, optional
+        Maximum number of gain updates (loudness evaluations after the
+        initial one), by default 3.
+
+    Returns
+    -------
+    tuple
+        The normalized audio signal, the sample rate and optionally
+        the normalization factor.
+
+    Notes
+    -----
+    The downmixed 48 kHz pressure signal is computed once and only
+    rescaled for every loudness evaluation. The first gain update
+    assumes `PHON_PER_DB` phon per dB, further updates follow the secant
+    through the last two evaluated loudness levels.
+    """
+    # downmix and resampling commute with the gain, do them only once
+    pressure_48k = fs_to_pressure(_mono_48k(audio, fs), dbfs_db)
+    N = mosqito.loudness_zwtv(
+        pressure_48k, 48000, field_type="diffuse")[0]
+    loud_lvl = 40 + 10*np.log2(N.mean())
     loud_diff = target_phon - loud_lvl
     logging.info(f"Before normalization: N={loud_lvl:.1f}")
     ratio_loud = 1
+    gain_db = 0
     n = 0
-    while abs(loud_diff) > 0.1:
-        ratio_loud *= 10 ** ((loud_diff)/20)
-        audio_pressure_it = audio_pressure * ratio_loud
-        loud_lvl, loudness = eq_loudness_lvl(audio_pressure_it, fs)
+    pressure_48k_it = np.empty_like(pressure_48k)
+    while abs(loud_diff) > 0.1 and n < max_iter:
+        if n == 0:
+            slope = PHON_PER_DB
+        else:
+            slope = (loud_lvl - prev_lvl) / (gain_db - prev_gain_db)
+        step_db = loud_diff / slope if slope > 0 else loud_diff
+        prev_gain_db, prev_lvl = gain_db, loud_lvl
+        gain_db += step_db
+        ratio_loud = math.exp(_LN10_OVER_20*gain_db)
+        np.multiply(pressure_48k, ratio_loud, out=pressure_48k_it)
+        N = mosqito.loudness_zwtv(
+            pressure_48k_it, 48000, field_type="diffuse")[0]
+        loud_lvl = 40 + 10*np.log2(N.mean())
         loud_diff = target_phon - loud_lvl
-        print(loud_diff)
+        logging.debug(loud_diff)
         n += 1
+    if abs(loud_diff) > 0.1:
+        logging.warning(f"Loudness normalization did not converge after {n} "+
+                        f"iterations, remaining difference {loud_diff:.2f} phon.")
     logging.info(f" After {n}th normalization: N={loud_lvl:.1f}")
     audio *= ratio_loud
-    headroom = 1/abs(audio).max()
-    headroom_db = 20*np.log10(headroom)
-    if abs(audio).max() > 1:
+    peak = max(audio.max(), -audio.min())
+    headroom_db = 20*np.log10(1/peak)
+    if peak > 1:
         logging.warning("Audio signal clipped after normalization.")
         raise ValueError("Audio signal clipped after normalization. "+
                          f"The level overflows for {headroom_db:.2f} dB. "+
@@ -4,9 +4,14 @@ It contains functions for basic processing, such as normalization, convolution,
 """
 
 import numpy.fft as fft
-from numpy import ndarray, where, zeros_like
+from numpy import ndarray, asarray, convolve, empty, float32, result_type, sqrt, vdot, where, zeros, zeros_like
+from numpy.lib.stride_tricks import sliding_window_view
 import scipy.signal as signal
+import scipy.fft as spfft
 import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
 import pyloudnorm as pyln
 from listeningpy.normalization import (
     peak_normalize,
@@ -17,6 +22,10 @@ from listeningpy.normalization import (
 from listeningpy.audiotools import audio_stats
 
 FILTERS = ['hp', 'lp']
+MAX_POLY_FACTOR = 1000  # larger up/down factors fall back to FFT resampling
+MIN_BLOCK_SIZE = 8192  # shortest FFT of the block convolution
+BLOCK_MIN_RATIO = 16  # stimulus/IR length ratio above which blocks are used
+DIRECT_MAX_TAPS = 12  # shorter IRs are convolved directly, without FFTs
 
 # logging.basicConfig(level=logging.DEBUG)
 
@@ -71,6 +80,435 @@ def gain_adjustment(
     audio_stats_logging(stimuli, fs_stimuli)
     return stimuli, fs_stimuli
 
+@lru_cache(maxsize=32)
+def _get_sos(order: int, freq: float, btype: str, fs: int) -> ndarray:
+    '''Returns a cached Butterworth filter in second-order sections.'''
+    return signal.butter(order, freq, btype, fs=fs, output='sos')
+
+def _filtered_level(
+        sos: ndarray,
+        audio: ndarray,
+        kind: str,
+        block: int=65536
+        ) -> float:
+    '''Returns the peak or RMS value of the filtered audio.
+
+    The audio is filtered block by block with the filter state carried
+    over, so the filtered signal is never held in memory as a whole.
+
+    Parameters
+    ----------
+    sos : numpy.ndarray
+        filter in second-order sections
+    audio : numpy.ndarray
+        2-D audio array
+    kind : str
+        'peak' or 'rms'
+    block : int, optional
+        number of samples filtered at once
+
+    Returns
+    -------
+    level : float
+        linear peak or RMS value of the filtered audio
+    '''
+    zi = zeros((sos.shape[0], 2, audio.shape[1]))
+    peak = 0.0
+    sum_sq = 0.0
+    for start in range(0, audio.shape[0], block):
+        y, zi = signal.sosfilt(sos, audio[start:start+block], axis=0, zi=zi)
+        if kind == 'peak':
+            peak = max(peak, y.max(), -y.min())
+        else:
+            sum_sq += vdot(y, y)
+    if kind == 'peak':
+        return float(peak)
+    return float(sqrt(sum_sq / audio.size))
+
+@lru_cache(maxsize=8)
+def fade_out_window(fs: int) -> ndarray:
+    '''Returns the HFT90D fade-out window applied to the tail of IRs.
+
+    The window is cached per sampling frequency and returned read-only.
+
+    Parameters
+    ----------
+    fs : int
+        sampling frequency
+
+    Returns
+    -------
+    fade_out_win : numpy.ndarray
+        1-D window of length fs/12.5 samples, decaying from 1
+    '''
+    HFT90D = [1, 1.942604, 1.340318, 0.440811, 0.043097]
+    size = int(fs/12.5)
+    fade_out_win = signal.windows.general_cosine(2*size,HFT90D)[-size:]
+    fade_out_win /= fade_out_win.max()
+    fade_out_win.flags.writeable = False
+    return fade_out_win
+
+def _outer_channels(audio: ndarray) -> ndarray:
+    '''First and last channel of a 2-D audio array as a strided view.
+
+    Mono audio is returned as it is, broadcasting against the other
+    input takes care of it.
+    '''
+    if audio.shape[1] == 1:
+        return audio
+    return audio[:, ::audio.shape[1]-1]
+
+def rfft_convolve(
+        in1: ndarray,
+        in2: ndarray,
+        workers: int=-1
+        ) -> ndarray:
+    '''Full linear convolution of real signals along the time axis.
+
+    Uses real-input FFTs of a fast length, the transforms of all the
+    channels are computed in parallel.
+
+    Parameters
+    ----------
+    in1, in2 : numpy.ndarray
+        2-D audio arrays with the same number of channels (or one)
+    workers : int, optional
+        number of threads used by scipy.fft, all cores by default
+
+    Returns
+    -------
+    audio : numpy.ndarray
+        2-D audio array of length len(in1)+len(in2)-1
+    '''
+    out_len = in1.shape[0] + in2.shape[0] - 1
+    n = spfft.next_fast_len(out_len, real=True)
+    spectrum = (spfft.rfft(in1, n, axis=0, workers=workers)
+                * spfft.rfft(in2, n, axis=0, workers=workers))
+    return spfft.irfft(spectrum, n, axis=0, workers=workers)[:out_len]
+
+def _direct_convolve(sig: ndarray, ir: ndarray) -> ndarray:
+    '''Full linear convolution in the time domain, channel by channel.
+
+    Several times faster than the FFT methods for IRs shorter than
+    DIRECT_MAX_TAPS, slower for longer ones.
+
+    Parameters
+    ----------
+    sig, ir : numpy.ndarray
+        2-D audio arrays with the same number of channels (or one)
+
+    Returns
+    -------
+    audio : numpy.ndarray
+        2-D audio array of length len(sig)+len(ir)-1
+    '''
+    channels = max(sig.shape[1], ir.shape[1])
+    out = empty(
+        (sig.shape[0]+ir.shape[0]-1, channels),
+        dtype=result_type(sig, ir))
+    for ch in range(channels):
+        out[:, ch] = convolve(
+            sig[:, ch if sig.shape[1] > 1 else 0],
+            ir[:, ch if ir.shape[1] > 1 else 0])
+    return out
+
+def _block_size(ir_len: int) -> int:
+    '''Picks the FFT size of block convolution.
+
+    Every block loses ir_len-1 samples to the overlap, a block of four
+    times the IR length keeps three quarters of each FFT useful while
+    the FFTs stay short. Blocks of short IRs are at least MIN_BLOCK_SIZE
+    long to keep the number of blocks (and their overhead) down.
+    '''
+    return spfft.next_fast_len(max(4*ir_len, MIN_BLOCK_SIZE), real=True)
+
+def _block_spectra(
+        audio: ndarray,
+        block_size: int,
+        overlap: int,
+        workers: int=-1
+        ) -> ndarray:
+    '''Spectra of the overlapping blocks of overlap-save convolution.
+
+    Parameters
+    ----------
+    audio : numpy.ndarray
+        2-D audio array
+    block_size : int
+        FFT size of a single block
+    overlap : int
+        number of samples shared by consecutive blocks, the IR length
+        minus one
+    workers : int, optional
+        number of threads used by scipy.fft, all cores by default
+
+    Returns
+    -------
+    spectra : numpy.ndarray
+        size (n_blocks, channels, block_size//2+1), the blocks cover the
+        full convolution of the audio with an IR of overlap+1 samples
+    '''
+    step = block_size - overlap
+    n_blocks = -(-(audio.shape[0] + overlap) // step)
+    padded = zeros(
+        ((n_blocks-1)*step + block_size, audio.shape[1]),
+        dtype=audio.dtype)
+    padded[overlap:overlap+audio.shape[0]] = audio
+    # (n_blocks, channels, block_size) view of overlapping blocks
+    blocks = sliding_window_view(padded, block_size, axis=0)[::step]
+    return spfft.rfft(blocks, axis=-1, workers=workers)
+
+def _overlap_save(
+        spectra: ndarray,
+        block_size: int,
+        overlap: int,
+        out_len: int,
+        workers: int=-1
+        ) -> ndarray:
+    '''Joins the inverse transforms of filtered block spectra.
+
+    Parameters
+    ----------
+    spectra : numpy.ndarray
+        block spectra multiplied by the IR spectrum, size
+        (n_blocks, channels, block_size//2+1)
+    block_size : int
+        FFT size of a single block
+    overlap : int
+        number of samples shared by consecutive blocks
+    out_len : int
+        length of the output in samples
+    workers : int, optional
+        number of threads used by scipy.fft, all cores by default
+
+    Returns
+    -------
+    audio : numpy.ndarray
+        2-D audio array of length out_len
+    '''
+    audio = spfft.irfft(spectra, block_size, axis=-1, workers=workers)
+    # the first overlap samples of each block are circularly aliased
+    audio = audio[..., overlap:].transpose(0, 2, 1)
+    return audio.reshape(-1, audio.shape[-1])[:out_len]
+
+class ConvolutionEngine:
+    '''Overlap-save convolution with a fixed IR.
+
+    The spectrum of the IR is computed once, so convolving many stimuli
+    with the same IR only transforms the stimuli.
+
+    Attributes
+    ----------
+    ir_len : int
+        length of the IR in samples
+    fs : int
+        IR sampling frequency
+    block_size : int
+        FFT size of a single block
+    step : int
+        number of output samples produced by a block
+    spectrum : numpy.ndarray
+        real-input FFT of the IR, size (block_size//2+1, channels)
+
+    Methods
+    -------
+    convolve(stimulus)
+        Returns the full linear convolution of stimulus with the IR.
+    '''
+    def __init__(
+            self,
+            ir: ndarray,
+            fs: int,
+            block_size: int=None,
+            workers: int=-1
+            ):
+        '''
+        Parameters
+        ----------
+        ir : numpy.ndarray
+            2-D audio array (IR)
+        fs : int
+            IR sampling frequency
+        block_size : int, optional
+            FFT size, rounded up to a fast length of at least twice the IR
+            length, chosen by _block_size by default
+        workers : int, optional
+            number of threads used by scipy.fft, all cores by default
+        '''
+        self.ir_len = ir.shape[0]
+        self.fs = fs
+        self.workers = workers
+        if block_size is None:
+            block_size = _block_size(self.ir_len)
+        self.block_size = spfft.next_fast_len(
+            max(block_size, 2*self.ir_len), real=True)
+        self.step = self.block_size - self.ir_len + 1
+        self.spectrum = spfft.rfft(ir, self.block_size, axis=0, workers=workers)
+
+    def convolve(self, stimulus: ndarray) -> ndarray:
+        '''Full linear convolution of stimulus with the IR.
+
+        Parameters
+        ----------
+        stimulus : numpy.ndarray
+            2-D audio array with the same number of channels as the IR
+            (or one)
+
+        Returns
+        -------
+        audio : numpy.ndarray
+            2-D audio array of length len(stimulus)+ir_len-1
+        '''
+        overlap = self.ir_len - 1
+        spectra = _block_spectra(
+            stimulus, self.block_size, overlap, self.workers)
+        return _overlap_save(
+            spectra * self.spectrum.T, self.block_size, overlap,
+            stimulus.shape[0] + overlap, self.workers)
+
+class StimulusConvolutionEngine:
+    '''Overlap-save convolution of a fixed stimulus with many IRs.
+
+    The block spectra of the stimulus are computed once, so convolving
+    the stimulus with many IRs (e.g. variants of a room) only transforms
+    the IRs and the output blocks.
+
+    Attributes
+    ----------
+    length : int
+        length of the stimulus in samples
+    max_ir_len : int
+        length of the longest IR accepted by the engine
+    block_size : int
+        FFT size of a single block
+    spectra : numpy.ndarray
+        block spectra of the stimulus, size
+        (n_blocks, channels, block_size//2+1)
+
+    Methods
+    -------
+    convolve(ir)
+        Returns the full linear convolution of the stimulus with ir.
+    from_spectra(spectra, length, max_ir_len, block_size)
+        Creates an engine from the spectra of another one.
+    '''
+    def __init__(
+            self,
+            stimulus: ndarray,
+            max_ir_len: int,
+            block_size: int=None,
+            workers: int=-1
+            ):
+        '''
+        Parameters
+        ----------
+        stimulus : numpy.ndarray
+            2-D audio array (stimulus)
+        max_ir_len : int
+            length of the longest IR to be convolved
+        block_size : int, optional
+            FFT size, rounded up to a fast length of at least twice
+            max_ir_len, chosen by _block_size by default
+        workers : int, optional
+            number of threads used by scipy.fft, all cores by default
+        '''
+        self.length = stimulus.shape[0]
+        self.max_ir_len = max_ir_len
+        self.workers = workers
+        if block_size is None:
+            block_size = _block_size(max_ir_len)
+        self.block_size = spfft.next_fast_len(
+            max(block_size, 2*max_ir_len), real=True)
+        self.spectra = _block_spectra(
+            stimulus, self.block_size, max_ir_len-1, workers)
+
+    @classmethod
+    def from_spectra(
+            cls,
+            spectra: ndarray,
+            length: int,
+            max_ir_len: int,
+            block_size: int,
+            workers: int=-1
+            ) -> 'StimulusConvolutionEngine':
+        '''Creates an engine from block spectra computed by another one.
+
+        Useful for sharing the spectra with worker processes, the
+        arguments are the attributes of the original engine.
+        '''
+        engine = cls.__new__(cls)
+        engine.length = length
+        engine.max_ir_len = max_ir_len
+        engine.block_size = block_size
+        engine.workers = workers
+        engine.spectra = spectra
+        return engine
+
+    def convolve(self, ir: ndarray) -> ndarray:
+        '''Full linear convolution of the stimulus with ir.
+
+        Parameters
+        ----------
+        ir : numpy.ndarray
+            2-D audio array (IR) of at most max_ir_len samples, with the
+            same number of channels as the stimulus (or one)
+
+        Returns
+        -------
+        audio : numpy.ndarray
+            2-D audio array of length length+len(ir)-1
+        '''
+        if ir.shape[0] > self.max_ir_len:
+            raise ValueError(
+                f"The IR has {ir.shape[0]} samples, the engine accepts "+
+                f"at most {self.max_ir_len}.")
+        spectrum = spfft.rfft(ir, self.block_size, axis=0, workers=self.workers)
+        return _overlap_save(
+            self.spectra * spectrum.T, self.block_size, self.max_ir_len-1,
+            self.length + ir.shape[0] - 1, self.workers)
+
+def prepare_ir(
+        ir: ndarray,
+        fs_ir: int,
+        fs: int,
+        fade_out: bool=True
+        ) -> tuple[ndarray, int]:
+    '''Prepares an IR for convolution with stimuli, as `convolution` does.
+
+    Parameters
+    ----------
+    ir : numpy.ndarray
+        2-D audio array (IR)
+    fs_ir : int
+        IR sampling frequency
+    fs : int
+        sampling frequency of stimuli
+    fade_out : bool, optional
+        Flag indicating whether to apply fade-out to the IR signal, by default True
+
+    Returns
+    -------
+    ir : numpy.ndarray
+        2-D float32 copy of the IR, resampled to fs and faded out
+    fs : int
+        sampling frequency of the IR
+    '''
+    # single precision halves the FFT buffers, the IR is always copied
+    # as the caller's IR may be reused (preloaded in adaptive tests)
+    ir = ir.astype(float32)
+    if fs_ir == fs:
+        logging.debug('IR and Stimuli sample rates are equal, no resampling needed.')
+    else:
+        logging.debug('IR and Stimuli sample rates differs, IR audio was resampled.')
+        ir, fs_ir = match_fs(ir, fs, fs_ir)
+    if fade_out:
+        fade_out_win = fade_out_window(fs)
+        # IRs shorter than the window get its decaying tail only
+        size = min(fade_out_win.shape[0], ir.shape[0])
+        ir[-size:] *= fade_out_win[-size:, None]
+        logging.debug(f'HFT90D Fade-out applied to last 0.1 s of IR.')
+    return ir, fs_ir
+
 def convolution(
         in1: ndarray,
         fs_in1: int,
@@ -80,12 +518,15 @@ def convolution(
         normalization: str='ir_sum',
         normalization_target: float=-6,
         normalization_prefilter: str='',
-        prefilter_critical_freq = 200
+        prefilter_critical_freq = 200,
+        workers: int=-1
         ) -> tuple[ndarray, int]:
     '''Performs convolution between IR and stimuli.
 
     Should accept both mono and stereo signals, 
-    but both in a form of 2D array.
+    but both in a form of 2D array. The output is always stereo, its
+    channels are the first and the last channels of both inputs
+    convolved with each other.
     
     Parameters
     ----------
@@ -107,50 +548,53 @@ def convolution(
         Type of prefiltering to apply before normalization, by default ''
     prefilter_critical_freq : int, optional
         Critical frequency for the prefilter, by default 200
+    workers : int, optional
+        number of threads used by scipy.fft, all cores by default. Use 1
+        when convolving in a pool of threads or processes.
 
     Returns
     -------
     audio : numpy.ndarray
-        2-D audio array
+        2-D float32 audio array
     fs_in1 : int
         IR sampling frequency
     '''
-    if fs_in1 == fs_in2:
-        logging.debug('IR and Stimuli sample rates are equal, no resampling needed.')
-    else:
-        logging.debug('IR and Stimuli sample rates differs, IR audio was resampled.')
-        in1, fs_in1 = match_fs(in1, fs_in2, fs_in1)
+    in1, fs_in1 = prepare_ir(in1, fs_in1, fs_in2, fade_out)
+    in2 = asarray(in2, dtype=float32)
     
     logging.debug(f'Stimuli shape before convolution: {in2.shape}')
     logging.debug(f'IR shape before convolution:      {in1.shape}')
-    logging.debug(f"The peak values are {abs(in2).max()} and {abs(in1).max()}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"The peak values are {abs(in2).max()} and {abs(in1).max()}")
 
-    if fade_out:
-        HFT90D = [1, 1.942604, 1.340318, 0.440811, 0.043097]
-        size = int(fs_in2/12.5)
-        fade_out_win = signal.windows.general_cosine(2*size,HFT90D)[-size:]
-        fade_out_win = fade_out_win/fade_out_win.max()
-        for i in in1.T:
-            i[-size:] *= fade_out_win
-        logging.debug(f'HFT90D Fade-out applied to last 0.1 s of IR.')
-    
-    # convolution
-    audio = signal.oaconvolve(in2.T, in1.T)[[0,-1]]
-    audio = audio.T
+    # convolution of the first and last channels of both inputs along
+    # the time axis, a single FFT for room IRs, overlap-save blocks for
+    # IRs much shorter than the stimulus and no FFT at all
+    # for a few taps
+    in1_out, in2_out = _outer_channels(in1), _outer_channels(in2)
+    if in1.shape[0] < DIRECT_MAX_TAPS:
+        audio = _direct_convolve(in2_out, in1_out)
+    elif in2.shape[0] > BLOCK_MIN_RATIO*in1.shape[0]:
+        engine = ConvolutionEngine(in1_out, fs_in1, workers=workers)
+        audio = engine.convolve(in2_out)
+    else:
+        audio = rfft_convolve(in2_out, in1_out, workers=workers)
+    if audio.shape[1] == 1:
+        audio = audio.repeat(2, axis=1)
     
-    # prefiltering for normalization
+    # prefiltering for normalization, peak and rms only need the level
+    # of the filtered signal, lufs needs the signal itself
+    audio_prefiltered = audio
     if normalization_prefilter == '':
-        audio_prefiltered = audio
-    elif normalization_prefilter in FILTERS:
-        sos = signal.butter(
-            12,
-            prefilter_critical_freq,
-            normalization_prefilter,
-            fs=fs_in1,
-            output='sos')
-        audio_prefiltered = signal.sosfilt(sos, audio, axis=0)
-    else:
+        pass
+    elif normalization_prefilter not in FILTERS:
         logging.warning('Specified normalization prefilter is not implemented.')
+    elif normalization == 'lufs':
+        sos = _get_sos(12, prefilter_critical_freq, normalization_prefilter, fs_in1)
+        audio_prefiltered = signal.sosfilt(sos, audio, axis=0)
+    elif normalization in ('peak', 'rms'):
+        sos = _get_sos(12, prefilter_critical_freq, normalization_prefilter, fs_in1)
+        audio_prefiltered = _filtered_level(sos, audio, normalization)
 
     # normalization
     if normalization == 'peak':
@@ -191,6 +635,51 @@ def convolution(
     audio_stats_logging(audio, fs_in1)
     return audio, fs_in1
 
+def batch_convolve(
+        ir: ndarray,
+        fs_ir: int,
+        stimuli_list: list[ndarray],
+        fs_list: list[int],
+        max_workers: int=None,
+        **conv_kwargs
+        ) -> list[tuple[ndarray, int]]:
+    '''Convolves one IR with many stimuli in parallel.
+
+    Each stimulus is processed by `convolution` in a thread pool, the
+    FFTs release the GIL, so the stimuli are convolved on all the cores
+    without copying them to other processes. Every task runs its FFTs
+    in a single thread, so that the pool does not oversubscribe the
+    cores. A single long convolution is better served by `convolution`
+    itself, which threads its FFTs.
+
+    Parameters
+    ----------
+    ir : numpy.ndarray
+        2-D audio array (IR)
+    fs_ir : int
+        IR sampling frequency
+    stimuli_list : list[numpy.ndarray]
+        2-D audio arrays (stimuli)
+    fs_list : list[int]
+        sampling frequencies of the stimuli
+    max_workers : int, optional
+        number of threads, chosen by ThreadPoolExecutor by default
+    conv_kwargs
+        keyword arguments passed to `convolution`, except workers
+
+    Returns
+    -------
+    results : list[tuple[numpy.ndarray, int]]
+        convolved audio and its sampling frequency for each stimulus,
+        in the order of stimuli_list
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(convolution, ir, fs_ir, s, fs, workers=1, **conv_kwargs)
+            for s, fs in zip(stimuli_list, fs_list)
+            ]
+        return [f.result() for f in futures]
+
 # def lf_dirac_combination(
 #         lf_ir: ndarray,
 #         fs_lf_ir: int,
@@ -235,10 +724,19 @@ def match_fs(
         fs_in2 : int,
         fs_in1 : int
         ) -> tuple[ndarray, int]:
-    '''Resamples in1 to match fs_in2.'''
+    '''Resamples in1 to match fs_in2.
+
+    Polyphase filtering is used for rational rate ratios with small
+    factors (all the common audio rates), FFT resampling otherwise.
+    '''
     logging.info(f'old length:{in1.shape[0]}, old fs:{fs_in1}')
-    new_len = int(in1.shape[0]*fs_in2/fs_in1)
-    new_in1 = signal.resample(in1, new_len)
+    g = gcd(int(fs_in2), int(fs_in1))
+    up, down = int(fs_in2)//g, int(fs_in1)//g
+    if max(up, down) <= MAX_POLY_FACTOR:
+        new_in1 = signal.resample_poly(in1, up, down, axis=0)
+    else:
+        new_len = int(in1.shape[0]*fs_in2/fs_in1)
+        new_in1 = signal.resample(in1, new_len)
     fs_in1 = fs_in2
     logging.info(f'new length:{new_in1.shape[0]}, new fs:{fs_in1}')
     return new_in1, fs_in1
@@ -269,12 +767,10 @@ def up_down(
     audio : numpy.ndarray
         2-D audio array
     '''
-    audio *= 10**(last/20)
-    ratio = 10**(step/20)
-    if direction:
-        audio*ratio
-    else:
-        audio/ratio    
+    if not direction:
+        step = -step
+    # a single in-place scaling for the previous level and the new step
+    audio *= 10**((last+step)/20)
     return audio
 
 def up_down_noise(
@@ -304,8 +800,7 @@ def up_down_noise(
     ndarray
         The audio signal with the added noise.
     """
-    noise = noise[:audio.shape[0]]
-    noise = up_down(audio, direction, last, step)
+    noise = up_down(noise[:audio.shape[0]].copy(), direction, last, step)
     audio += noise
     return audio
 
@@ -316,6 +811,7 @@ def audio_stats_logging(
     peak, rms, loudness = audio_stats(audio, fs)
     logging.info(f'Processed audio stats: peak: {peak:.2f} dBFS, '+
         f'rms: {rms:.2f} dBFS, loudness: {loudness:.2f} dB LUFS.')
-    if abs(audio).max() > 1:
+    # peak is in dBFS, above 0 dB means samples outside [-1, 1]
+    if peak > 0:
         logging.warning(f'Clipping occured on full scale after processing!')
 
@@ -2,9 +2,9 @@
 Functions for preparing sets for listening tests.
 """
 
-from pandas import DataFrame, concat
+import numpy as np
+from pandas import DataFrame, Categorical, CategoricalDtype, concat
 import logging
-from itertools import combinations
 import os
 # logging.basicConfig(level=logging.INFO)
 
@@ -48,16 +48,16 @@ def read_folder(
     audio_paths : list[str]
         list containing paths to audio files inside a specified folder
     '''
-    if parent == None:
+    if parent is None:
         audio_folder = folder
     else:
         audio_folder = os.path.join(parent, folder)
-    audio_paths = os.scandir(audio_folder)
-    audio_paths = [
-        os.path.join(audio_folder, p.name) for p in audio_paths if p.is_file()
-        ]
-    if filterwav:
-        audio_paths = filter_wavs(audio_paths)
+    # single pass, is_file() uses the type cached by scandir
+    with os.scandir(audio_folder) as entries:
+        audio_paths = [
+            e.path for e in entries
+            if e.is_file() and (not filterwav or e.name.lower().endswith('.wav'))
+            ]
     logging.info(f"Read these files: {audio_paths}")
     return audio_paths
 
@@ -106,6 +106,49 @@ def randomization(df: DataFrame) -> DataFrame:
 
 ### COMBINATIONS PREPARATION ###
 
+def _abx_sets(
+        pairs,
+        constant_reference: bool=False
+        ) -> DataFrame:
+    '''Builds the ABX sets of the given pairs of paths in one array.
+
+    Each pair is used in both orders, with the first and (unless
+    constant_reference) the second path of the pair as the reference.
+
+    Parameters
+    ----------
+    pairs : numpy.ndarray
+        (N, 2) object array of paths
+    constant_reference : bool, optional
+        True keeps only the first path of the pair as the reference
+
+    Returns
+    -------
+    audio_path_comb : pandas.DataFrame
+        Sets sorted by the '0' column, IDs identify the pairs. The path
+        columns are categorical.
+    '''
+    swapped = pairs[:, ::-1]
+    if constant_reference:
+        blocks = [(pairs, pairs[:, 0]), (swapped, pairs[:, 0])]
+    else:
+        blocks = [
+            (pairs, pairs[:, 0]), (pairs, pairs[:, 1]),
+            (swapped, pairs[:, 0]), (swapped, pairs[:, 1])
+            ]
+    ab = np.concatenate([b[0] for b in blocks])
+    ids = np.char.mod('%02d', np.arange(pairs.shape[0]))
+    # every path repeats many times, the columns share one dictionary
+    # so that they remain comparable with each other
+    paths = CategoricalDtype(np.unique(pairs.astype(str)))
+    audio_path_comb = DataFrame({
+        '0': Categorical(ab[:, 0], dtype=paths),
+        '1': Categorical(ab[:, 1], dtype=paths),
+        'ID': np.tile(ids, len(blocks)),
+        'Ref': Categorical(np.concatenate([b[1] for b in blocks]), dtype=paths)
+        })
+    return audio_path_comb.sort_values(by=['0'])
+
 def abx_combination(
         folder: str,
         parent: str=".",
@@ -147,21 +190,11 @@ def abx_combination(
     Returns combinations for standard ABX.
 
     '''
-    audio_path_list = read_folder(folder, parent)
-    audio_path_comb = DataFrame(combinations(audio_path_list, 2), columns=['0', '1'])
-    audio_path_comb['ID'] = audio_path_comb.index.format(name=False, formatter="{0:0=2d}".format)
-    if constant_reference:
-        audio_path_comb["Ref"] = audio_path_comb.loc[:, '0']
-    else:
-        audio_path_comb_copy = audio_path_comb.copy()
-        audio_path_comb["Ref"] = audio_path_comb.loc[:, '0']
-        audio_path_comb_copy["Ref"] = audio_path_comb_copy.loc[:, '1']
-        audio_path_comb = concat([audio_path_comb, audio_path_comb_copy])
-        
-    audio_path_comb_inv = audio_path_comb.copy()
-    audio_path_comb_inv.loc[:, ['1', '0']] = audio_path_comb_inv.loc[:, ['0', '1']].values
-    audio_path_comb = concat([audio_path_comb, audio_path_comb_inv]).reset_index(drop=True)
-    audio_path_comb = audio_path_comb.sort_values(by=['0'])
+    paths = np.array(read_folder(folder, parent), dtype=object)
+    # index pairs in the order of itertools.combinations
+    i, j = np.triu_indices(len(paths), k=1)
+    pairs = np.column_stack((paths[i], paths[j]))
+    audio_path_comb = _abx_sets(pairs, constant_reference)
     logging.info("ABX combinations returned.")
     return audio_path_comb
 
@@ -210,21 +243,11 @@ def abx_combination_subset(
     Returns combinations for standard ABX with the first path as the reference.
     '''
     audio_path_list = read_folder(folder, parent)
-    audio_path_comb = DataFrame(combinations(audio_path_list, 2), columns=['0', '1'])
-    audio_path_comb = audio_path_comb[audio_path_comb.loc[:,'0'] == audio_path_list[0]]
-    audio_path_comb['ID'] = audio_path_comb.index.format(name=False, formatter="{0:0=2d}".format)
-    if constant_reference:
-        audio_path_comb["Ref"] = audio_path_comb.loc[:, '0']
-    else:
-        audio_path_comb_copy = audio_path_comb.copy()
-        audio_path_comb["Ref"] = audio_path_comb.loc[:, '0']
-        audio_path_comb_copy["Ref"] = audio_path_comb_copy.loc[:, '1']
-        audio_path_comb = concat([audio_path_comb, audio_path_comb_copy])
-        
-    audio_path_comb_inv = audio_path_comb.copy()
-    audio_path_comb_inv.loc[:, ['1', '0']] = audio_path_comb_inv.loc[:, ['0', '1']].values
-    audio_path_comb = concat([audio_path_comb, audio_path_comb_inv]).reset_index(drop=True)
-    audio_path_comb = audio_path_comb.sort_values(by=['0'])
+    # pairs containing the first path, in the order of abx_combination
+    pairs = np.array(
+        [(audio_path_list[0], p) for p in audio_path_list[1:]], dtype=object
+        ).reshape(-1, 2)
+    audio_path_comb = _abx_sets(pairs, constant_reference)
     logging.info("ABX combinations returned.")
     return audio_path_comb
 
@@ -244,15 +267,16 @@ def adaptive_combination(folder: str, parent: str):
     audio_path_df : pandas.DataFrame
         Sorted sets for adaptive method test.
     '''
-    audio_path_df = DataFrame()
+    frames = []
     sets = sub_folders(folder, parent)
     for s in sets:
         paths = read_folder(s)
         ids = [os.path.split(p)[1][:-4] for p in paths]
         set_list = [os.path.split(s)[1] for p in paths]
         dict_ = {'set': set_list, 'id': ids, 'path':paths}
-        df = DataFrame(dict_)
-        audio_path_df = concat([audio_path_df, df])
+        frames.append(DataFrame(dict_))
+    # a single concat instead of growing the frame set by set
+    audio_path_df = concat(frames) if frames else DataFrame()
     return audio_path_df
 
 def adaptive_irs(folder: str):
@@ -1,13 +1,105 @@
 """Module for playing back stimuli."""
 from soundfile import SoundFile
-from sounddevice import play
-from numpy import ndarray
+from sounddevice import OutputStream
+from numpy import ndarray, empty, float32
 import logging
+import threading
+import atexit
 from typing import Callable
 from listeningpy.processing import straight
 
 # logging.basicConfig(level=logging.INFO)
 
+BLOCK_SIZE = 1024  # frames requested by the output stream callback
+
+class _Player:
+    '''Output stream that stays open and plays whatever it is given.
+
+    Opening a PortAudio stream for every stimulus (as sounddevice.play
+    does) takes tens of milliseconds. The stream of a player is opened
+    once and outputs silence when there is nothing to play.
+
+    Parameters
+    ----------
+    fs : int
+        sampling frequency
+    channels : int
+        number of output channels
+    '''
+    def __init__(self, fs: int, channels: int):
+        self._lock = threading.Lock()
+        self._sound = None
+        self._pos = 0
+        self.stream = OutputStream(
+            samplerate=fs,
+            channels=channels,
+            dtype='float32',
+            blocksize=BLOCK_SIZE,
+            callback=self._callback
+            )
+        self.stream.start()
+
+    def _callback(self, outdata, frames, time, status):
+        with self._lock:
+            if self._sound is None:
+                outdata.fill(0)
+                return
+            chunk = self._sound[self._pos:self._pos+frames]
+            n = chunk.shape[0]
+            outdata[:n] = chunk
+            outdata[n:] = 0
+            self._pos += n
+            if self._pos >= self._sound.shape[0]:
+                self._sound = None
+
+    def play(self, sound: ndarray) -> None:
+        '''Starts playing sound, the previous one is interrupted.'''
+        with self._lock:
+            self._sound = sound
+            self._pos = 0
+
+    def stop(self) -> None:
+        '''Interrupts the playback.'''
+        with self._lock:
+            self._sound = None
+
+    def close(self) -> None:
+        '''Stops and closes the output stream.'''
+        self.stop()
+        self.stream.stop()
+        self.stream.close()
+
+_players = {}
+
+def _play(sound: ndarray, fs: int) -> None:
+    '''Plays sound on a persistent stream, returns immediately.
+
+    Like sounddevice.play, any playback in progress is stopped. The
+    stream is reused while the sampling frequency and number of channels
+    stay the same, a stream with other parameters is closed.
+    '''
+    sound = sound.astype(float32, copy=False)
+    if sound.ndim == 1:
+        sound = sound[:, None]
+    key = (int(fs), sound.shape[1])
+    # at most one stream holds the device
+    for k in [k for k in _players if k != key]:
+        _players.pop(k).close()
+    if key not in _players:
+        _players[key] = _Player(*key)
+    _players[key].play(sound)
+
+@atexit.register
+def close_players() -> None:
+    '''Closes the output streams opened by play_sound.
+
+    Called automatically at interpreter exit, the streams are reopened
+    on the next playback.
+    '''
+    for player in _players.values():
+        player.close()
+    _players.clear()
+
 def play_sound(
         path: str=None,
         sound: ndarray=None,
@@ -32,12 +124,16 @@ def play_sound(
     if path is not None:
         with SoundFile(path, 'r') as f:
             logging.info(f'File {path} was succesfully opened.')
-            sound = f.read(always_2d=True)
+            # decoded straight into the float32 buffer that is played,
+            # without soundfile's float64 intermediate, read() trims it
+            # to the frames actually read
+            sound = empty((f.frames, f.channels), dtype=float32)
+            sound = f.read(out=sound, always_2d=True)
             sound, fs = processing_func(sound, f.samplerate, **kwargs)
-            play(sound, fs)
+            _play(sound, fs)
             logging.info(f'Stimuli of a of a shape {sound.shape} was played.')
     elif sound is not None and fs is not None:
-        play(sound, fs)
+        _play(sound, fs)
         logging.info(f'Provided stimuli of a shape {sound.shape} was' +
             ' played without further processing.')
     else: